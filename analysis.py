@@ -0,0 +1,288 @@
+""" analysis.py
+This module calculates the spectrum of the output and a few numbers
+for the quality of the signal: the total harmonic distortion (THD),
+the spurious free dynamic range (SFDR) and the DC offset. The spectrum
+is the Welch average of Blackman-Harris windowed segments of the
+output in volts, calculated with rfft in float32. With raw output the
+samples are the int16 DAC codes that are written, converted back to
+volts, so the quantisation of the DAC is in the spectrum. The
+sidelobes of this window are low enough to see harmonics and spurs of about -90 dB.
+Long buffers are read in chunks, so they do not have to be in memory
+twice. A continuous output is repeated by the DAQ, so it is analysed
+as if it were repeated and the seam where the buffer starts again
+shows up in the spectrum.
+
+The Analyzer does the calculation on a worker thread and keeps the
+last results by the hash of the buffer, so showing the result of the
+same output again is instant.
+"""
+
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import fft, signal
+
+from waveforms import buildoutput, outputlength, outputsamples
+from presets import settingshash
+from nidaqwriter import voltstoraw, rawtovolts
+from parallelgen import PARALLELSAMPLES
+
+
+__author__ = "Jaimy Plugge"
+
+
+# Amount of harmonics of the fundamental that count for the THD.
+HARMONICS = 10
+
+# Half the width of the main lobe of the window in bins.
+WINDOW = "blackmanharris"
+LOBE = 4
+
+
+class Cancelled(Exception):
+    pass
+
+
+def arraysource(outputsignal):
+    """
+    Return the read function of an output buffer: the samples
+    start up to stop as float32.
+    """
+    def read(start, stop):
+        return np.asarray(outputsignal[:,start:stop], dtype=np.float32)
+    return read
+
+
+def rawsource(read, coefficients):
+    """
+    Return the read function of the raw output: the samples of
+    read rounded to the DAC codes of the device with its scaling
+    coefficients and converted back to volts.
+    """
+    # A task with one channel only has coefficients for that one.
+    coefficients = (list(coefficients) + [coefficients[-1]])[:2]
+    def readraw(start, stop):
+        return rawtovolts(voltstoraw(read(start, stop), coefficients),
+                          coefficients)
+    return readraw
+
+
+def settingssource(settings, waveformmatrix, cache=None, coefficients=None):
+    """
+    Return the read function, length and whether the output is
+    repeated, for the output of the settings. Very long finite
+    outputs are not made at once but read with outputsamples.
+    With the scaling coefficients of the device the raw output
+    is read, see rawsource.
+    """
+    length = outputlength(settings)
+    if length is not None and length > PARALLELSAMPLES:
+        def read(start, stop):
+            return outputsamples(settings, waveformmatrix,
+                                 np.arange(start, stop)).astype(np.float32)
+        periodic = False
+    else:
+        if cache is not None:
+            mode, outputsignal = cache.output(settings, waveformmatrix,
+                                              dtype=np.float32)
+        else:
+            mode, outputsignal = buildoutput(settings, waveformmatrix,
+                                             np.float32)
+        read = arraysource(outputsignal)
+        length = outputsignal.shape[1]
+        periodic = mode == "Continuous"
+    if coefficients is not None:
+        read = rawsource(read, coefficients)
+    return read, length, periodic
+
+
+def spectrum(read, length, samplerate, periodic=False, segment=2**16,
+             batch=16, cancel=None, progress=None):
+    """
+    Return the frequencies and the Welch averaged power spectrum
+    of both channels and the mean of every channel. The power
+    is scaled so that the bins of a sine with amplitude A add up
+    to A**2/2. Segments overlap by half. cancel is a
+    threading.Event that stops the calculation, progress is
+    called with the part that is done.
+    """
+    if periodic:
+        # Enough repeats to cross the seam a few times.
+        total = max(2*length, 8*segment)
+    else:
+        segment = min(segment, length)
+        total = length
+    step = max(1, segment//2)
+    starts = np.arange(0, total-segment+1, step)
+    window = signal.get_window(WINDOW, segment).astype(np.float32)
+    scale = 2/(segment*np.sum(window.astype(float)**2))
+
+    def readwrapped(start, stop):
+        if not periodic:
+            return read(start, stop)
+        pieces = []
+        while start < stop:
+            offset = start % length
+            size = min(stop-start, length-offset)
+            pieces.append(read(offset, offset+size))
+            start += size
+        return np.hstack(pieces)
+
+    power = np.zeros((2, segment//2+1))
+    for first in range(0, len(starts), batch):
+        if cancel is not None and cancel.is_set():
+            raise Cancelled()
+        batchstarts = starts[first:first+batch]
+        chunk = readwrapped(batchstarts[0], batchstarts[-1]+segment)
+        for channel in range(2):
+            frames = sliding_window_view(chunk[channel], segment)[::step]
+            frames = frames - frames.mean(axis=1, keepdims=True)
+            transform = fft.rfft(frames*window, axis=1)
+            power[channel] += np.sum(np.abs(transform)**2, axis=0)
+        if progress is not None:
+            progress(min(1, (first+batch)/len(starts)))
+    power *= scale/len(starts)
+
+    # The mean over the whole buffer, not only the segments.
+    total = np.zeros(2)
+    for start in range(0, length, 2**22):
+        total += np.sum(read(start, min(start+2**22, length)), axis=1,
+                        dtype=float)
+    freqs = fft.rfftfreq(segment, 1/samplerate)
+    return freqs, power, total/length
+
+
+def tonepower(power, center):
+    return np.sum(power[max(0, center-LOBE):center+LOBE+1])
+
+
+def quality(freqs, power):
+    """
+    Return the fundamental, THD and SFDR of one channel. The
+    fundamental is the highest peak, the harmonics are looked
+    for near the multiples of its frequency. Without a peak,
+    for example for a constant output, they are nan.
+    """
+    result = {"fundamental": np.nan, "thd": np.nan, "thdpercent": np.nan,
+              "sfdr": np.nan, "spur": np.nan}
+    if len(power) <= 2*LOBE+2 or np.max(power[LOBE+1:]) <= 0:
+        return result
+    peak = int(np.argmax(power[LOBE+1:])) + LOBE+1
+    lobe = np.arange(max(0, peak-LOBE), min(len(power), peak+LOBE+1))
+    center = np.sum(lobe*power[lobe])/np.sum(power[lobe])
+    fundamental = tonepower(power, peak)
+    result["fundamental"] = center*(freqs[1]-freqs[0])
+
+    harmonics = 0
+    for harmonic in range(2, HARMONICS+1):
+        guess = int(round(harmonic*center))
+        if guess+LOBE >= len(power):
+            break
+        near = power[guess-LOBE:guess+LOBE+1]
+        harmonics += tonepower(power, guess-LOBE+int(np.argmax(near)))
+    result["thd"] = 10*np.log10(max(harmonics, 1E-30)/fundamental)
+    result["thdpercent"] = 100*np.sqrt(harmonics/fundamental)
+
+    # The biggest peak that is not DC or the fundamental.
+    rest = power.copy()
+    rest[:LOBE+1] = 0
+    rest[max(0, peak-2*LOBE):peak+2*LOBE+1] = 0
+    spur = int(np.argmax(rest))
+    result["sfdr"] = 10*np.log10(fundamental/max(tonepower(rest, spur),
+                                                  1E-30))
+    result["spur"] = freqs[spur]
+    return result
+
+
+def analyse(read, length, samplerate, periodic=False, segment=2**16,
+            cancel=None, progress=None):
+    """
+    Return the spectrum and the quality of both channels. When
+    the fundamental is so close to DC that its harmonics are
+    inside the main lobe, the spectrum is calculated again with
+    longer segments.
+    """
+    freqs, power, mean = spectrum(read, length, samplerate, periodic,
+                                  segment, cancel=cancel, progress=progress)
+    results = [quality(freqs, row) for row in power]
+    lowest = min([result["fundamental"]/freqs[1] for result in results
+                  if not np.isnan(result["fundamental"])], default=np.inf)
+    longest = length if not periodic else 8*length
+    if lowest < 10*LOBE and len(freqs) < longest//2:
+        segment = int(2**np.ceil(np.log2((len(freqs)-1)*2*10*LOBE/lowest)))
+        freqs, power, mean = spectrum(read, length, samplerate, periodic,
+                                      min(segment, longest), cancel=cancel,
+                                      progress=progress)
+        results = [quality(freqs, row) for row in power]
+    for result, dc in zip(results, mean):
+        result["dc"] = dc
+    return {"freqs": freqs.astype(np.float32),
+            "power": power.astype(np.float32), "channels": results}
+
+
+class Analyzer:
+    def __init__(self, segment=2**16, maxresults=16):
+        self.segment = segment
+        self.maxresults = maxresults
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(1)
+        self.cancel = threading.Event()
+        self.progress = 0
+
+    def submit(self, key, samplerate, source):
+        """
+        Start the analysis of the buffer with hash <key> and
+        return a future of the result. source is called on the
+        worker thread and returns the read function, the length
+        and whether the output is repeated. A result with the
+        same key is returned right away and an analysis that is
+        still running is stopped.
+        """
+        with self.lock:
+            if key in self.results:
+                self.results.move_to_end(key)
+                future = Future()
+                future.set_result(self.results[key])
+                return future
+        self.cancel.set()
+        self.cancel = threading.Event()
+        self.progress = 0
+        return self.pool.submit(self.run, key, samplerate, source,
+                                self.cancel)
+
+    def submitsettings(self, settings, waveformmatrix, cache=None,
+                       coefficients=None):
+        """
+        Analyse the output of the settings, as raw output when the
+        scaling coefficients of the device are given. The hash of
+        the settings is the hash of the buffer in the cache, the
+        coefficients are added to it for raw output.
+        """
+        key = settingshash(settings, waveformmatrix.shape[1])
+        if coefficients is not None:
+            key = (key, tuple(tuple(row) for row in coefficients))
+        return self.submit(key, float(settings["samplerate"]),
+                           lambda: settingssource(settings, waveformmatrix,
+                                                  cache, coefficients))
+
+    def run(self, key, samplerate, source, cancel):
+        read, length, periodic = source()
+        result = analyse(read, length, samplerate, periodic, self.segment,
+                         cancel, self.setprogress)
+        with self.lock:
+            self.results[key] = result
+            if len(self.results) > self.maxresults:
+                self.results.popitem(last=False)
+        return result
+
+    def setprogress(self, part):
+        self.progress = part
+
+    def shutdown(self):
+        self.cancel.set()
+        self.pool.shutdown(cancel_futures=True)
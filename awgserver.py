@@ -0,0 +1,470 @@
+""" awgserver.py
+This module contains a small asyncio server that makes it possible to
+control the output DAQ from other programs, for example measurement
+scripts that run in their own process. The server listens on a TCP
+port or a Unix socket and uses a simple protocol: every command is one
+line of JSON and every reply is one line of JSON. Raw sample arrays
+are uploaded as a binary frame directly after the "upload" command.
+
+Commands (the "id" key is optional and is sent back in the reply):
+    {"cmd": "set", "settings": {"waveform1": "Sine", "freq1": 10}}
+    {"cmd": "channels", "chan1": "myDAQ1/ao0", "chan2": "myDAQ1/ao1"}
+    {"cmd": "send"}
+    {"cmd": "upload", "shape": [2, 1000], "dtype": "<f8",
+     "mode": "Finite", "samplerate": 10000}   + shape[0]*shape[1] samples
+    {"cmd": "start"}
+    {"cmd": "stop"}
+    {"cmd": "trigger", "source": "/myDAQ1/PFI0", "edge": "Rising",
+     "retriggerable": true}
+    {"cmd": "status"}
+    {"cmd": "subscribe"}
+    {"cmd": "stats"}
+
+Every reply contains "ok" and the time it took to handle the command
+in "latency_ms". Subscribed clients also get {"event": ...} lines when
+the output is switched on or off.
+
+The dtype of an upload can be "<f8", "<f4" or "<i2", the last one are
+raw DAC codes that are written with the unscaled writer. Start the
+server with --raw to send all other output as raw codes too.
+
+Start the server with "python awgserver.py --simulate" to try it out
+without a DAQ.
+"""
+
+
+import argparse
+import asyncio
+import json
+import socket
+import time
+
+import numpy as np
+
+from nidaqwriter import Writer, Simwriter
+from waveforms import DEFAULTSETTINGS, OUTPUTOPTIONS, lookuptable, buildoutput
+
+
+__author__ = "Jaimy Plugge"
+
+
+class Frameerror(ValueError):
+    """
+    An upload whose size is unknown, so the rest of the
+    connection can not be read anymore.
+    """
+
+
+class Awgserver:
+    """
+    Serves the commands of all connected clients. The commands
+    of one client are handled in the order they were sent. The
+    calls to the Writer are done in a worker thread, one at a
+    time, so the event loop keeps answering other clients while
+    an output is being written to the DAQ.
+    """
+    def __init__(self, daqout):
+        self.daqout = daqout
+        # The trigger and raw output are set with the "trigger"
+        # command and --raw instead.
+        self.settings = {name: value for name, value in DEFAULTSETTINGS.items()
+                         if name not in OUTPUTOPTIONS}
+        self.time_axis, self.waveformmatrix = lookuptable(100000)
+        self.outputmode = None
+        self.outputsignal = None
+        self.state = "off"
+        # Counts the outputs that were started, so a done event of
+        # an output that was replaced already is ignored.
+        self.generation = 0
+        self.subscribers = set()
+        self.latencies = {}
+        self.loop = None
+        self.outputlock = None
+        self.commands = {"set": self.setcommand,
+                         "channels": self.channelscommand,
+                         "send": self.sendcommand,
+                         "upload": self.uploadcommand,
+                         "start": self.startcommand,
+                         "stop": self.stopcommand,
+                         "trigger": self.triggercommand,
+                         "status": self.statuscommand,
+                         "subscribe": self.subscribecommand,
+                         "stats": self.statscommand}
+
+    async def start_tcp(self, host, port):
+        self.setup()
+        return await asyncio.start_server(self.handleclient, host, port)
+
+    async def start_unix(self, path):
+        self.setup()
+        return await asyncio.start_unix_server(self.handleclient, path)
+
+    def setup(self):
+        self.loop = asyncio.get_running_loop()
+        self.outputlock = asyncio.Lock()
+        self.daqout.task.register_done_event(self.donecallback)
+
+    async def handleclient(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                starttime = time.perf_counter()
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("A command should be a JSON object")
+                except ValueError as error:
+                    self.reply(writer, {}, starttime, error=error)
+                    continue
+                if request.get("cmd") == "upload":
+                    try:
+                        request["data"] = await self.readframe(reader, request)
+                    except Frameerror as error:
+                        # The samples can not be skipped, so the next
+                        # line can not be found anymore.
+                        self.reply(writer, request, starttime, error=error)
+                        break
+                    except ValueError as error:
+                        self.reply(writer, request, starttime, error=error)
+                        continue
+                # The commands of one client are handled in order, so
+                # a "stop" after a "send" is never done before it.
+                await self.handlecommand(writer, request, starttime)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.subscribers.discard(writer)
+            writer.close()
+
+    async def readframe(self, reader, request):
+        """
+        Read the samples of an upload. When the frame is wrong
+        but its size is known the samples are read anyway, so
+        the connection can be used for the next command.
+        """
+        try:
+            dtype = np.dtype(request.get("dtype", "<f8"))
+            shape = tuple(int(n) for n in request["shape"])
+        except (KeyError, TypeError, ValueError) as error:
+            raise Frameerror(f"Upload without a valid shape and dtype: "
+                             f"{error!r}")
+        if len(shape) == 0 or min(shape) < 0:
+            raise Frameerror("shape should be [channels, samples]")
+        data = await reader.readexactly(int(np.prod(shape))*dtype.itemsize)
+        if dtype.newbyteorder("<") not in (np.dtype("<f8"), np.dtype("<f4"),
+                                           np.dtype("<i2")):
+            raise ValueError("dtype should be float64, float32 or int16")
+        if len(shape) != 2 or shape[0] not in (1, 2):
+            raise ValueError("shape should be [channels, samples] with 1 or "
+                             "2 channels")
+        return np.frombuffer(data, dtype=dtype).reshape(shape)
+
+    async def handlecommand(self, writer, request, starttime):
+        cmd = request.get("cmd")
+        try:
+            if cmd not in self.commands:
+                raise ValueError(f"Unknown command {cmd!r}")
+            result = await self.commands[cmd](writer, request)
+        except Exception as error:
+            self.reply(writer, request, starttime, error=error)
+        else:
+            self.reply(writer, request, starttime, result=result)
+
+    def reply(self, writer, request, starttime, result=None, error=None):
+        latency = 1000*(time.perf_counter()-starttime)
+        cmd = request.get("cmd")
+        if cmd in self.commands:
+            count, total, maximum = self.latencies.get(cmd, (0, 0., 0.))
+            self.latencies[cmd] = (count+1, total+latency,
+                                   max(maximum, latency))
+        message = {"cmd": cmd, "ok": error is None, "latency_ms": latency}
+        if "id" in request:
+            message["id"] = request["id"]
+        if error is not None:
+            message["error"] = str(error)
+        elif result is not None:
+            message.update(result)
+        self.sendline(writer, message)
+
+    def sendline(self, writer, message):
+        if writer.is_closing():
+            self.subscribers.discard(writer)
+            return
+        writer.write(json.dumps(message).encode() + b"\n")
+
+    def broadcast(self, message):
+        for writer in list(self.subscribers):
+            self.sendline(writer, message)
+
+    async def runoutput(self, func, *args):
+        """
+        Call a method of the Writer in a worker thread. The lock
+        makes sure two commands never talk to the DAQ at once.
+        """
+        async with self.outputlock:
+            return await self.loop.run_in_executor(None, func, *args)
+
+    def checkoutput(self, outputmode, outputsignal, samplerate):
+        """
+        Raise a ValueError when the output can not be sent, before
+        the output that is running is stopped.
+        """
+        plan = self.daqout.planoutput(int(samplerate), outputsignal.shape[1],
+                                      outputmode,
+                                      self.daqout.retriggering(),
+                                      self.daqout.writesraw(outputsignal))
+        if len(plan["problems"]) > 0:
+            raise ValueError(" ".join(plan["problems"]))
+
+    def writeoutput(self, outputmode, outputsignal, samplerate):
+        self.checkoutput(outputmode, outputsignal, samplerate)
+        self.daqout.pausefunc()
+        self.daqout.sample_rate = int(samplerate)
+        if outputmode == "Finite":
+            self.daqout.singleoutput(outputsignal)
+        else:
+            self.daqout.outputcontinuously(outputsignal)
+        self.generation += 1
+
+    def writezero(self):
+        self.daqout.pausefunc()
+        self.daqout.outputcontinuously(np.zeros((2, 10), dtype=float),
+                                       trigger=False)
+        self.generation += 1
+
+    def setstate(self, state):
+        self.state = state
+        self.broadcast({"event": "status", "state": state,
+                        "mode": self.outputmode, "time": time.time()})
+
+    def donecallback(self, task_handle, status, callback_data):
+        # This is called from a thread of the DAQ driver.
+        self.loop.call_soon_threadsafe(self.outputdone, status,
+                                       self.generation)
+        return 0
+
+    def outputdone(self, status, generation):
+        self.loop.create_task(self.finishoutput(status, generation))
+
+    async def finishoutput(self, status, generation):
+        def stoptask():
+            if generation != self.generation:
+                return False
+            self.daqout.task.stop()
+            return True
+        if await self.runoutput(stoptask):
+            self.broadcast({"event": "done", "status": status,
+                            "time": time.time()})
+            self.setstate("off")
+
+    async def setcommand(self, writer, request):
+        settings = request.get("settings", {})
+        unknown = set(settings) - set(self.settings)
+        if unknown:
+            raise ValueError(f"Unknown settings {sorted(unknown)}")
+        self.settings.update(settings)
+        return {"settings": self.settings}
+
+    async def channelscommand(self, writer, request):
+        def changetask():
+            self.daqout.changetask(request["chan1"], request.get("chan2", ""))
+            self.daqout.task.register_done_event(self.donecallback)
+            self.generation += 1
+        await self.runoutput(changetask)
+        self.setstate("off")
+        return {"chan1": self.daqout.chan_name1,
+                "chan2": self.daqout.chan_name2}
+
+    def buildandwrite(self, settings, dtype):
+        outputmode, outputsignal = buildoutput(settings, self.waveformmatrix,
+                                               dtype)
+        self.writeoutput(outputmode, outputsignal, settings["samplerate"])
+        return outputmode, outputsignal
+
+    async def sendcommand(self, writer, request):
+        settings = dict(self.settings)
+        dtype = np.float32 if self.daqout.rawoutput else float
+        # The output is made while holding the lock, so commands of
+        # other clients that came later are done after it.
+        outputmode, outputsignal = await self.runoutput(self.buildandwrite,
+                                                        settings, dtype)
+        self.outputmode = outputmode
+        self.outputsignal = outputsignal
+        self.setstate("on")
+        return {"mode": outputmode, "samples": outputsignal.shape[1]}
+
+    async def uploadcommand(self, writer, request):
+        data = request["data"]
+        # int16 frames are raw DAC codes and are written as they are.
+        outputsignal = np.zeros((2, data.shape[1]), 
+                                dtype=data.dtype.newbyteorder("="))
+        outputsignal[:data.shape[0],:] = data
+        outputmode = request.get("mode", "Finite")
+        if outputmode not in ("Finite", "Continuous"):
+            raise ValueError("mode should be Finite or Continuous")
+        samplerate = request.get("samplerate", self.settings["samplerate"])
+        # Nothing is kept before the output is known to be good, so
+        # a wrong upload does not break the next start.
+        if request.get("start", True):
+            await self.runoutput(self.writeoutput, outputmode, outputsignal,
+                                 samplerate)
+        else:
+            await self.runoutput(self.checkoutput, outputmode, outputsignal,
+                                 samplerate)
+        self.settings["samplerate"] = samplerate
+        self.outputmode = outputmode
+        self.outputsignal = outputsignal
+        if request.get("start", True):
+            self.setstate("on")
+        return {"mode": outputmode, "samples": outputsignal.shape[1]}
+
+    async def startcommand(self, writer, request):
+        if self.outputsignal is None:
+            raise ValueError("Nothing to start, use send or upload first")
+        await self.runoutput(self.writeoutput, self.outputmode,
+                             self.outputsignal, self.settings["samplerate"])
+        self.setstate("on")
+        return {"mode": self.outputmode}
+
+    async def stopcommand(self, writer, request):
+        await self.runoutput(self.writezero)
+        self.setstate("off")
+        return {}
+
+    async def triggercommand(self, writer, request):
+        """
+        Set the start trigger for the next output, an empty
+        source means a software start.
+        """
+        if request.get("edge", "Rising") not in ("Rising", "Falling"):
+            raise ValueError("edge should be Rising or Falling")
+        self.daqout.triggersource = request.get("source", "")
+        self.daqout.triggeredge = request.get("edge", "Rising")
+        self.daqout.retriggerable = bool(request.get("retriggerable", False))
+        return {"source": self.daqout.triggersource,
+                "edge": self.daqout.triggeredge,
+                "retriggerable": self.daqout.retriggerable}
+
+    async def statuscommand(self, writer, request):
+        bursts = None
+        if self.state == "on" and self.daqout.triggersource:
+            bursts = await self.runoutput(self.daqout.burstsfired)
+        return {"state": self.state, "mode": self.outputmode,
+                "bursts": bursts,
+                "chan1": self.daqout.chan_name1,
+                "chan2": self.daqout.chan_name2,
+                "settings": self.settings}
+
+    async def subscribecommand(self, writer, request):
+        self.subscribers.add(writer)
+        return {"state": self.state}
+
+    async def statscommand(self, writer, request):
+        return {"latency_ms": {cmd: {"count": count, "mean": total/count,
+                                     "max": maximum}
+                               for cmd, (count, total, maximum)
+                               in self.latencies.items()}}
+
+
+class Awgclient:
+    """
+    Small blocking client for the Awgserver that can be used
+    in measurement scripts, for example:
+
+        awg = Awgclient(port=5025)
+        awg.command("set", settings={"waveform1": "Sine", "freq1": 10})
+        awg.command("send")
+    """
+    def __init__(self, host="127.0.0.1", port=5025, path=None):
+        if path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(path)
+        else:
+            self.sock = socket.create_connection((host, port))
+        self.file = self.sock.makefile("rb")
+        self.events = []
+        self.count = 0
+
+    def command(self, cmd, **kwargs):
+        self.count += 1
+        request = dict(kwargs, cmd=cmd, id=self.count)
+        self.sock.sendall(json.dumps(request).encode() + b"\n")
+        return self.waitreply(self.count)
+
+    def upload(self, samples, mode="Finite", samplerate=None, start=True):
+        samples = np.ascontiguousarray(np.atleast_2d(samples), dtype="<f8")
+        self.count += 1
+        request = {"cmd": "upload", "id": self.count, "mode": mode,
+                   "shape": list(samples.shape), "dtype": "<f8",
+                   "start": start}
+        if samplerate is not None:
+            request["samplerate"] = samplerate
+        self.sock.sendall(json.dumps(request).encode() + b"\n"
+                          + samples.tobytes())
+        return self.waitreply(self.count)
+
+    def waitreply(self, id):
+        while True:
+            message = self.readmessage()
+            if message.get("id") == id:
+                if not message["ok"]:
+                    raise RuntimeError(message["error"])
+                return message
+
+    def readmessage(self):
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError("The AWG server closed the connection")
+        message = json.loads(line)
+        if "event" in message:
+            self.events.append(message)
+        return message
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+async def serve(args):
+    if args.simulate:
+        daqout = Simwriter(args.chan1, args.chan2, args.samplerate, args.raw)
+    else:
+        daqout = Writer(args.chan1, args.chan2, args.samplerate, args.raw)
+    awgserver = Awgserver(daqout)
+    if args.unix:
+        server = await awgserver.start_unix(args.unix)
+    else:
+        server = await awgserver.start_tcp(args.host, args.port)
+    print(f"AWG server listening on {args.unix or (args.host, args.port)}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        daqout.stopfunc()
+        print("Stopped DAQ output")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Control the AWG over a "
+                                                 "TCP port or Unix socket.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5025)
+    parser.add_argument("--unix", default=None,
+                        help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--chan1", default="myDAQ1/ao0")
+    parser.add_argument("--chan2", default="myDAQ1/ao1")
+    parser.add_argument("--samplerate", type=int, default=10000)
+    parser.add_argument("--raw", action="store_true",
+                        help="write int16 DAC codes instead of volts")
+    parser.add_argument("--simulate", action="store_true",
+                        help="use the simulated writer instead of a DAQ")
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+""" benchmark.py
+This script measures how long it takes to prepare the output of a few
+typical settings and how much memory the buffer that is written to
+the DAQ needs. It compares the scaled float64 output with the raw
+output, which is calculated in float32 and converted to int16 DAC
+codes, and making long finite outputs at once with making them in 
+parallel. Give the channels of a DAQ with --chan1 and --chan2 to also
+time the write to the device, otherwise the Simwriter is used.
+
+The "prep MS/s" column is how fast the buffer is made and handed to
+the driver, not the rate the DAQ outputs at. With --stream a finite
+output is streamed at the highest rate of the device and timed until
+its done event, which shows whether the streaming keeps up. On the
+Simwriter this only checks that the chunks are made in time.
+
+    python benchmark.py
+    python benchmark.py --chan1 myDAQ1/ao0 --chan2 myDAQ1/ao1 --stream 10
+"""
+
+
+import argparse
+import threading
+import time
+
+import numpy as np
+
+from nidaqwriter import Writer, Simwriter
+from waveforms import DEFAULTSETTINGS, lookuptable, buildoutput
+from parallelgen import Parallelgenerator
+
+
+__author__ = "Jaimy Plugge"
+
+
+CASES = {"DC ramp 100 s": dict(DEFAULTSETTINGS, samplerate=100000,
+                               output="Finite", offs1=5, offs2=-5,
+                               ramptime=10, dctime1=80, dctime2=80),
+         "Sine x 1000": dict(DEFAULTSETTINGS, samplerate=100000,
+                             output="Finite", amount=1000,
+                             waveform1="Sine", freq1=10,
+                             waveform2="Triangle", freq2=10),
+         "Continuous saw": dict(DEFAULTSETTINGS, samplerate=100000,
+                                waveform1="Saw", freq1=1234,
+                                waveform2="Block", freq2=50)}
+
+
+def timeit(func, repeat):
+    """
+    Return the result of func and the shortest time of
+    <repeat> calls.
+    """
+    best = np.inf
+    for _ in range(repeat):
+        starttime = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter()-starttime)
+    return result, best
+
+
+def benchmark(daqout, repeat):
+    time_axis, waveformmatrix = lookuptable(100000)
+    print(f"{'case':<16}{'output':<16}{'generate [s]':>14}"
+          f"{'write [s]':>12}{'buffer [MB]':>13}{'prep MS/s':>11}")
+    for name, settings in CASES.items():
+        for rawoutput in (False, True):
+            dtype = np.float32 if rawoutput else float
+            daqout.rawoutput = rawoutput
+            daqout.sample_rate = int(settings["samplerate"])
+            (mode, outputsignal), generatetime = timeit(
+                lambda: buildoutput(settings, waveformmatrix, dtype), repeat)
+            if rawoutput:
+                # The conversion to DAC codes is part of preparing
+                # the output, so time it as well.
+                outputsignal, converttime = timeit(
+                    lambda: daqout.rawsamples(outputsignal), repeat)
+                generatetime += converttime
+
+            def write():
+                daqout.pausefunc()
+                daqout.singleoutput(outputsignal)
+            _, writetime = timeit(write, repeat)
+            daqout.pausefunc()
+
+            samples = outputsignal.shape[1]
+            rate = samples/(generatetime+writetime)/1E6
+            print(f"{name:<16}"
+                  f"{'raw int16' if rawoutput else 'scaled float64':<16}"
+                  f"{generatetime:>14.4f}{writetime:>12.4f}"
+                  f"{outputsignal.nbytes/1E6:>13.1f}{rate:>11.1f}")
+
+
+def benchmarkparallel(repeat):
+    """
+    Compare making a finite output at once with making it in
+    chunks on all cores, for which the time until the first
+    chunk can be sent matters most.
+    """
+    time_axis, waveformmatrix = lookuptable(100000)
+    generator = Parallelgenerator(waveformmatrix)
+    generator.startpool()
+    print(f"\n{'case':<16}{'serial [s]':>12}{'first chunk [s]':>17}"
+          f"{'parallel [s]':>14}{'workers':>9}")
+    try:
+        for name, settings in CASES.items():
+            if settings["output"] != "Finite":
+                continue
+            _, serialtime = timeit(lambda: buildoutput(settings, 
+                                                       waveformmatrix), repeat)
+            firsttime = paralleltime = np.inf
+            for _ in range(repeat):
+                starttime = time.perf_counter()
+                output = generator.generate(settings)
+                next(output.chunks())
+                firsttime = min(firsttime, time.perf_counter()-starttime)
+                output.wait()
+                paralleltime = min(paralleltime, time.perf_counter()-starttime)
+                output.close()
+            print(f"{name:<16}{serialtime:>12.4f}{firsttime:>17.4f}"
+                  f"{paralleltime:>14.4f}{generator.workers:>9}")
+    finally:
+        generator.shutdown()
+
+
+def benchmarkstream(daqout, seconds, chunksize=2**16):
+    """
+    Stream a finite sine of <seconds> at the highest sample
+    rate of the device and time it from the start of the
+    calculation until the done event of the task.
+    """
+    samplerate = int(daqout.capabilities()["maxrate"])
+    settings = dict(DEFAULTSETTINGS, samplerate=samplerate, output="Finite",
+                    waveform1="Sine", freq1=10, waveform2="Triangle",
+                    freq2=10, amount=int(np.ceil(seconds*10)))
+    time_axis, waveformmatrix = lookuptable(100000)
+    generator = Parallelgenerator(waveformmatrix, chunksize=chunksize)
+    generator.startpool()
+    done = threading.Event()
+
+    def donecallback(task_handle, status, callback_data):
+        done.set()
+        return 0
+
+    daqout.pausefunc()
+    daqout.task.register_done_event(donecallback)
+    daqout.sample_rate = samplerate
+    output = None
+    try:
+        starttime = time.perf_counter()
+        output = generator.generate(settings)
+        daqout.streamoutput(output)
+        if not done.wait(timeout=2*output.length/samplerate + 10):
+            print("\nThe stream did not finish in time")
+            return
+        streamtime = time.perf_counter()-starttime
+    finally:
+        daqout.pausefunc()
+        daqout.task.register_done_event(None)
+        if output is not None:
+            output.close()
+        generator.shutdown()
+    duration = output.length/samplerate
+    print(f"\n{'stream':<16}{'samples':>12}{'duration [s]':>14}"
+          f"{'took [s]':>10}{'MS/s':>8}")
+    print(f"{'Sine at max':<16}{output.length:>12}{duration:>14.3f}"
+          f"{streamtime:>10.3f}{output.length/streamtime/1E6:>8.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the preparation "
+                                                 "of the output buffers.")
+    parser.add_argument("--chan1", default="")
+    parser.add_argument("--chan2", default="")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--stream", type=float, default=0, metavar="SECONDS",
+                        help="also time a stream of this many seconds")
+    args = parser.parse_args()
+    if args.chan1:
+        daqout = Writer(args.chan1, args.chan2, 10000)
+    else:
+        daqout = Simwriter("sim/ao0", "sim/ao1", 10000)
+    try:
+        benchmark(daqout, args.repeat)
+        if args.stream > 0:
+            benchmarkstream(daqout, args.stream)
+    finally:
+        daqout.stopfunc()
+    benchmarkparallel(args.repeat)
+
+
+if __name__ == "__main__":
+    main()
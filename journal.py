@@ -0,0 +1,151 @@
+""" journal.py
+This module keeps a journal of a session of the AWG: every change of
+the settings, every send and stop and every done event of the output,
+together with how long every stage took. The journal is a file with one
+JSON object per line that is only appended to, so it is still readable
+when the program crashed. Changed settings are written as only the
+values that changed. With replay.py a journal can be run again on the
+simulated DAQ to compare the timings of two versions of the code.
+"""
+
+
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from presets import PRESETDIR
+
+
+__author__ = "Jaimy Plugge"
+
+
+JOURNALDIR = os.path.join(PRESETDIR, "journal")
+
+# The modules whose code is timed, see codeversion.
+SOURCES = ["nidaq_awg.py", "nidaqwriter.py", "waveforms.py", "preview.py",
+           "presets.py", "parallelgen.py", "writerprocess.py",
+           "segments.py", "outputpipeline.py"]
+
+
+def codeversion():
+    """
+    Return a short hash of the source code, so journals of
+    different versions of the code can be told apart.
+    """
+    digest = hashlib.sha256()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in SOURCES:
+        try:
+            with open(os.path.join(directory, name), "rb") as file:
+                digest.update(file.read())
+        except OSError:
+            pass
+    return digest.hexdigest()[:12]
+
+
+class Stagetimer:
+    """
+    Time the stages of a send, stop or plot:
+
+        timer = Stagetimer()
+        with timer.stage("write"):
+            ...
+        timer.timings   # {"write": seconds}
+    """
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name):
+        starttime = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = (self.timings.get(name, 0)
+                                  + time.perf_counter()-starttime)
+
+
+class Journal:
+    def __init__(self, path=None):
+        """
+        Without a path a new file with the date and time in its
+        name is made in JOURNALDIR.
+        """
+        if path is None:
+            os.makedirs(JOURNALDIR, exist_ok=True)
+            path = os.path.join(JOURNALDIR,
+                                time.strftime("session-%Y%m%d-%H%M%S.jsonl"))
+        self.path = path
+        self.lock = threading.Lock()
+        self.starttime = time.perf_counter()
+        self.settings = {}
+        self.file = open(path, "a", buffering=1)
+        self.record("session", version=codeversion(),
+                    date=time.strftime("%Y-%m-%d %H:%M:%S"))
+
+    def record(self, event, timings=None, **fields):
+        """
+        Append an event. The done events come from the thread of
+        the DAQ, so writing is locked.
+        """
+        line = {"t": round(time.perf_counter()-self.starttime, 6),
+                "event": event}
+        line.update(fields)
+        if timings is not None:
+            line["timings"] = {name: round(seconds, 6)
+                               for name, seconds in timings.items()}
+        text = json.dumps(line, separators=(",", ":"))
+        with self.lock:
+            if not self.file.closed:
+                self.file.write(text + "\n")
+
+    def changes(self, settings):
+        """
+        Return the settings that changed since the last call and
+        remember the new settings.
+        """
+        changed = {name: value for name, value in settings.items()
+                   if name not in self.settings
+                   or self.settings[name] != value}
+        self.settings = dict(settings)
+        return changed
+
+    def recordsettings(self, settings, event="change", timings=None,
+                       **fields):
+        """
+        Record an event with the settings that changed since the
+        last recorded settings.
+        """
+        self.record(event, timings=timings, changes=self.changes(settings),
+                    **fields)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def readjournal(path):
+    """
+    Return the events of a journal. The settings of every event
+    are filled in from the changes before it.
+    """
+    events = []
+    settings = {}
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line of a crashed session can be cut off.
+                break
+            if "changes" in event:
+                settings.update(event["changes"])
+                event["settings"] = dict(settings)
+            events.append(event)
+    return events
@@ -8,19 +8,32 @@ to comminucate with the output DAQ.
 """
 
 
+import queue
 import time
 import tkinter as tk
 from tkinter import ttk
+from tkinter import simpledialog, messagebox, filedialog
 
 import numpy as np
 import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from scipy import signal
+from matplotlib.backends.backend_tkagg import (FigureCanvasTkAgg, 
+                                               NavigationToolbar2Tk)
 import nidaqmx
 from nidaqmx import stream_writers
 
 from nidaqwriter import Writer
+from writerprocess import Writerprocess
+from nidaqreader import Reader
 from entrywidget import Entrywidget
+from waveforms import (WAVEFORMDICT, DEFAULTSETTINGS, lookuptable, 
+                       isdcramp, isprofile, outputlength)
+from segments import loadprofile
+from presets import Waveformcache, Presetstore
+from preview import Previewengine
+from parallelgen import Parallelgenerator
+from outputpipeline import Outputpipeline
+from journal import Journal, Stagetimer
+from analysis import Analyzer, Cancelled
 
 
 __author__ = "Jaimy Plugge"
@@ -29,56 +42,14 @@ __author__ = "Jaimy Plugge"
 FONT = (44)
 
 
-def constructdcramp(samplerate, ramptime, dctime, amplitude, offset):
-    """
-    This function is implemented in this program because 
-    it is a certain thing that I needed for one of my 
-    experiments. It takes the amplitude and sends it for
-    <dctime> seconds. Before this constant voltage is set, 
-    the voltage will be ramped up via a sine function and 
-    also ramped down afterwards. The offset is for how many
-    seconds zero voltage should be send before the ramping.
-    """
-    time_axis = np.arange(0, offset+dctime+(2*ramptime), 1/samplerate)
-    #ramp = .5*(1+np.sin(np.arange(-.5*np.pi, .5*np.pi, np.pi
-    #                                                   / (ramptime*samplerate))))
-    ramp = 1/(ramptime)*np.arange(0,ramptime,1/(samplerate))
-    arb = amplitude * np.hstack((np.zeros(int(offset*samplerate)),
-                                 ramp,
-                                 np.ones(int(dctime*samplerate)),
-                                 np.flip(ramp)))
-    return time_axis, arb
-
-
-def returnfinite(x, waveformtype, freq):
-    """
-    I use this method to return exactly one full pulse
-    of a certain waveform type to use for the send finite
-    pulses function. This proved to be easier to use than
-    the waveforms that are already made in the Mainwindow
-    class.
-    """
-    if waveformtype == "Sine":
-        y = np.sin(2*np.pi*freq*x)
-    elif waveformtype == "Block":
-        y = signal.square(2*np.pi*freq*x)
-    elif waveformtype == "Triangle":
-        y = signal.sawtooth(2*np.pi*freq*x, width=0.5)
-    elif waveformtype == "Saw":
-        y = signal.sawtooth(2*np.pi*freq*x)
-    else:
-        print("No waveform is chosen")
-        y = np.zeros(len(x))
-    return y
-
-
 class Choosechannelwindow:
     """
     This is the window that will open on top of the main
     window to selsct the DAQ and channels that will be
-    used for the output.
+    used for the output. With kind="ai" it shows the input
+    channels, which are used for the readback.
     """
-    def __init__(self, mainwindow, channel1var, channel2var):
+    def __init__(self, mainwindow, channel1var, channel2var, kind="ao"):
         self.window = tk.Toplevel(mainwindow)
 
         self.window.title('Init Window')
@@ -89,7 +60,11 @@ class Choosechannelwindow:
         channellist = [""]
         try:
             for device in system.devices:
-                for channel in device.ao_physical_chans:
+                if kind == "ai":
+                    physical_chans = device.ai_physical_chans
+                else:
+                    physical_chans = device.ao_physical_chans
+                for channel in physical_chans:
                     channellist.append(channel.name)
         except:
             tk.messagebox.showerror(
@@ -128,6 +103,53 @@ class Choosechannelwindow:
         return self.channel1var_ccw, self.channel2var_ccw
 
 
+class Analysiswindow:
+    """
+    The window with the spectrum of the output and its THD,
+    SFDR and DC offset, see analysis.py. It is hidden instead
+    of closed, so it can be shown again right away.
+    """
+    def __init__(self, mainwindow, closefunc):
+        self.window = tk.Toplevel(mainwindow)
+        self.window.title('Spectrum Analysis')
+        self.window.protocol("WM_DELETE_WINDOW", closefunc)
+        self.window.rowconfigure(0, weight=1)
+        self.window.columnconfigure(0, weight=1)
+
+        self.fig, self.axs = plt.subplots()
+        self.canvas = FigureCanvasTkAgg(self.fig, master=self.window)
+        self.canvas.get_tk_widget().grid(row=0, column=0, sticky="nsew")
+        self.infolbl = tk.Label(master=self.window, font=FONT, 
+                                justify=tk.LEFT, anchor="w")
+        self.infolbl.grid(row=1, column=0, sticky="nsew")
+
+    def status(self, text):
+        self.infolbl.config(text=text)
+
+    def show(self, result, names, title):
+        self.axs.clear()
+        freqs = result["freqs"]
+        for power, name in zip(result["power"], names):
+            self.axs.plot(freqs[1:], 10*np.log10(np.maximum(power[1:], 1E-20)), 
+                          linewidth=0.8, label=name)
+        self.axs.set_xscale("log")
+        self.axs.set_xlabel('Frequency [Hz]')
+        self.axs.set_ylabel('Power [dBV²]')
+        self.axs.set_title(title)
+        self.axs.legend()
+        self.canvas.draw()
+
+        lines = []
+        for channel, name in zip(result["channels"], names):
+            lines.append(f"{name}:  DC offset {channel['dc']:.4g} V,  "
+                         f"fundamental {channel['fundamental']:.6g} Hz,  "
+                         f"THD {channel['thd']:.1f} dB "
+                         f"({channel['thdpercent']:.3g} %),  "
+                         f"SFDR {channel['sfdr']:.1f} dBc "
+                         f"(spur at {channel['spur']:.6g} Hz)")
+        self.status("\n".join(lines))
+
+
 class Mainwindow:
     def __init__(self):
         self.mainwindow = tk.Tk()
@@ -147,9 +169,23 @@ class Mainwindow:
         self.mainwindow.rowconfigure([0, 1, 2], weight=1)
         self.mainwindow.columnconfigure([0, 1], minsize=100, weight=1)
 
+        # Presets and the cache with their compiled output
+        self.cache = Waveformcache()
+        # Every change, send, stop and done event of this session
+        # is written to a journal, see replay.py.
+        self.journal = Journal()
+        self.presetstore = Presetstore(cache=self.cache)
+
         # Make user interface
         self.channel1var = tk.StringVar()
         self.channel2var = tk.StringVar()
+        self.readbackchannel1var = tk.StringVar()
+        self.readbackchannel2var = tk.StringVar()
+        self.readbackvar = tk.BooleanVar(value=False)
+        self.writerprocessvar = tk.BooleanVar(value=True)
+        self.analysisvar = tk.BooleanVar(value=False)
+        # The segment list of the "Profile" output, see segments.py.
+        self.profile = None
         self.createmenu()
         self.createsystemsettings()
         self.waveformvars = [tk.StringVar(),tk.StringVar()]
@@ -171,22 +207,12 @@ class Mainwindow:
                             padx=self.xpadding, pady=self.ypadding, 
                             sticky="nsew")
 
-        self.time_axis = np.linspace(0,1,100000)
-        self.waveformmatrix = np.zeros((5, len(self.time_axis)), dtype=float)
-        self.waveformmatrix[0,:] = np.zeros(len(self.time_axis))                
-        self.waveformmatrix[1,:] = np.sin(2*np.pi*self.time_axis)                       
-        self.waveformmatrix[2,:] = signal.square(2*np.pi*self.time_axis)                
-        self.waveformmatrix[3,:] = signal.sawtooth(2*np.pi*self.time_axis, width=0.5)  
-        self.waveformmatrix[4,:] = signal.sawtooth(2*np.pi*self.time_axis)              
+        self.time_axis, self.waveformmatrix = lookuptable(100000)
 
         self.multichan = False
 
 
-        self.waveformdict = {"Constant": 0,
-                             "Sine": 1,
-                             "Block": 2,
-                             "Triangle": 3,
-                             "Saw": 4}
+        self.waveformdict = WAVEFORMDICT
 
 
         self.fig, self.axs = plt.subplots()
@@ -201,18 +227,59 @@ class Mainwindow:
         self.canvas = FigureCanvasTkAgg(self.fig, master=self.plotframe)
         self.canvas.draw()
         self.canvas.get_tk_widget().grid(row=0,column=0,sticky="nsew")
+        self.toolbar = NavigationToolbar2Tk(self.canvas, self.plotframe, 
+                                            pack_toolbar=False)
+        self.toolbar.grid(row=1,column=0,sticky="nsew")
+        self.canvas.mpl_connect("scroll_event", self.scrollzoom)
+
+        # Engine that calculates the samples of the visible part
+        # of the plot.
+        self.previewengine = Previewengine(self.waveformmatrix)
+        self.previewsettings = None
+        self.previewartists = []
+        self.previewpending = False
+
+        # The spectrum of the output is calculated on a thread of
+        # the analyzer. The last sent settings are analysed, or the 
+        # settings in the window when nothing was sent yet.
+        self.analyzer = Analyzer()
+        self.analysiswindow = None
+        self.analysisfuture = None
+        self.analysispending = False
+        self.sentsettings = None
+
+        # Pool for the very long outputs. The pipeline does the
+        # stages of the preview and of sending an output, the same
+        # way as the replay of a journal.
+        self.generator = Parallelgenerator(self.waveformmatrix)
+        self.pipeline = Outputpipeline(self.waveformmatrix, self.cache, 
+                                       self.generator, self.previewengine)
 
         # Make sure self.daqout is a thing, the writer class will
         # be called once the channels are chosen.
         self.daqout = False
 
+        # The reader for the loopback capture is made once the
+        # readback channels are chosen. The readback is drawn on
+        # top of the plot a few times per second.
+        self.readback = False
+        self.readbackperiod = 1
+        self.readbackartists = []
+        self.readbacktotal = 0
+        self.spillpath = None
+        self.mainwindow.after(250, self.updatereadback)
+        self.mainwindow.after(200, self.updatebursts)
+        # The done events of the output task, see callback.
+        self.doneevents = queue.Queue()
+        self.mainwindow.after(100, self.checkdone)
+
         # Start main loop
         self.mainwindow.mainloop()
 
     def createmenu(self):
         """
-        This function creates the top menu. The default settings 
-        option does not work yet!
+        This function creates the top menu. The presets menu 
+        lists the saved presets every time it is opened.
         """
         menubar = tk.Menu(self.mainwindow)
         windowmenu = tk.Menu(menubar, tearoff=0)
@@ -222,15 +289,75 @@ class Mainwindow:
         windowmenu.add_command(label="Exit", command=self.quit_me)
         menubar.add_cascade(label="Window", menu=windowmenu)
 
+        presetmenu = tk.Menu(menubar, tearoff=0)
+        self.loadpresetmenu = tk.Menu(presetmenu, tearoff=0, 
+                                      postcommand=self.updatepresetmenus)
+        self.deletepresetmenu = tk.Menu(presetmenu, tearoff=0,
+                                        postcommand=self.updatepresetmenus)
+        presetmenu.add_command(label="Save preset", command=self.savepreset)
+        presetmenu.add_cascade(label="Load preset", menu=self.loadpresetmenu)
+        presetmenu.add_cascade(label="Delete preset", 
+                               menu=self.deletepresetmenu)
+        presetmenu.add_separator()
+        presetmenu.add_command(label="Clear waveform cache", 
+                               command=self.cache.clear)
+        menubar.add_cascade(label="Presets", menu=presetmenu)
+
         channelmenu = tk.Menu(menubar, tearoff=0)
         channelmenu.add_command(label="Change channels", 
                                 command=self.definechannels)
         channelmenu.add_command(label="Add channels", 
                                 command=self.definechannels)
+        channelmenu.add_separator()
+        channelmenu.add_checkbutton(label="Writer in separate process", 
+                                    variable=self.writerprocessvar)
         menubar.add_cascade(label="Channels", menu=channelmenu)
 
+        readbackmenu = tk.Menu(menubar, tearoff=0)
+        readbackmenu.add_checkbutton(label="Loopback capture", 
+                                     variable=self.readbackvar, 
+                                     command=self.togglereadback)
+        readbackmenu.add_command(label="Readback channels", 
+                                 command=self.definereadbackchannels)
+        readbackmenu.add_separator()
+        readbackmenu.add_command(label="Save capture to file", 
+                                 command=self.choosespillfile)
+        readbackmenu.add_command(label="Stop saving capture", 
+                                 command=lambda: self.setspillfile(None))
+        menubar.add_cascade(label="Readback", menu=readbackmenu)
+
+        analysismenu = tk.Menu(menubar, tearoff=0)
+        analysismenu.add_checkbutton(label="Spectrum analysis", 
+                                     variable=self.analysisvar, 
+                                     command=self.toggleanalysis)
+        menubar.add_cascade(label="Analysis", menu=analysismenu)
+
+        profilemenu = tk.Menu(menubar, tearoff=0)
+        profilemenu.add_command(label="Load segment list", 
+                                command=self.chooseprofile)
+        menubar.add_cascade(label="Profile", menu=profilemenu)
+
         self.mainwindow.config(menu=menubar)
 
+    def chooseprofile(self):
+        """
+        Load a segment list from a .json file and switch to the
+        "Profile" output.
+        """
+        path = filedialog.askopenfilename(
+            title="Load segment list", 
+            filetypes=[("Segment list", "*.json"), ("All files", "*")])
+        if not path:
+            return
+        try:
+            self.profile = loadprofile(path)
+        except (OSError, ValueError) as error:
+            messagebox.showerror('Profile error', 
+                                 f'Error: Could not load segment list: {error}')
+            return
+        self.outputvar.set("Profile")
+        self.systemsettingsupdate(self.amountentry)
+
     def definechannels(self):
         """
         Function that opens the choose channel window and starts 
@@ -249,9 +376,8 @@ class Mainwindow:
             if len(self.channel1var.get()) > 0:
                 if self.daqout != False:
                     self.daqout.stopfunc()
-                self.daqout = Writer(self.channel1var.get(),
-                                     self.channel2var.get(), 10000)
-                self.daqout.task.register_done_event(self.callback)
+                self.startwriter()
+                self.updateratelimit()
                 self.sendbtn.config(state='normal')
                 self.sendzerobtn.config(state='normal')
             else:
@@ -264,15 +390,167 @@ class Mainwindow:
             self.multichan = True
             if self.daqout != False:
                 self.daqout.stopfunc()
-            self.daqout = Writer(self.channel1var.get(),self.channel2var.get(), 
-                                 10000)
-            self.daqout.task.register_done_event(self.callback)
+            self.startwriter()
+            self.updateratelimit()
             self.sendbtn.config(state='normal')
             self.sendzerobtn.config(state='normal')
         self.legend.legendHandles[0]._sizes = [30]
         self.legend.legendHandles[1]._sizes = [30]
         self.canvas.draw()
 
+    def startwriter(self):
+        """
+        Make the writer for the chosen channels. In a separate
+        process the output keeps going when the window is busy
+        and is turned off when the window is closed.
+        """
+        if self.writerprocessvar.get():
+            self.daqout = Writerprocess(self.channel1var.get(),
+                                        self.channel2var.get(), 
+                                        int(float(self.samprentry.get())))
+        else:
+            self.daqout = Writer(self.channel1var.get(),
+                                 self.channel2var.get(), 
+                                 int(float(self.samprentry.get())))
+        self.pipeline.daqout = self.daqout
+        self.daqout.task.register_done_event(self.callback)
+
+    def updateratelimit(self):
+        """
+        Limit the sample rate entry to the highest rate the
+        device can do with the chosen channels.
+        """
+        try:
+            maxrate = self.daqout.capabilities()["maxrate"]
+        except nidaqmx.DaqError:
+            return
+        self.samprentry.minmax = [1, maxrate]
+        self.maxratelbl.config(text=f"max {maxrate:g}")
+        if float(self.samprentry.get()) > maxrate:
+            self.samprentry.delete(0, tk.END)
+            self.samprentry.insert(0, int(maxrate))
+            self.plotupdate()
+
+    def definereadbackchannels(self):
+        """
+        Choose the analog inputs that are connected to the 
+        outputs for the loopback capture.
+        """
+        initialize = Choosechannelwindow(self.mainwindow, 
+                                         self.readbackchannel1var, 
+                                         self.readbackchannel2var, kind="ai")
+        self.mainwindow.wait_window(initialize.window)
+        self.readbackchannel1var, self.readbackchannel2var = initialize.returnvalues()
+        if self.readback != False:
+            self.readback.stop()
+        chan_names = [self.readbackchannel1var.get(), 
+                      self.readbackchannel2var.get()]
+        if any(len(name) > 0 for name in chan_names):
+            self.readback = Reader(chan_names, spillpath=self.spillpath)
+        else:
+            self.readback = False
+            self.readbackvar.set(False)
+
+    def togglereadback(self):
+        if self.readbackvar.get() and self.readback == False:
+            self.definereadbackchannels()
+        elif not self.readbackvar.get() and self.readback != False:
+            self.readback.stop()
+
+    def choosespillfile(self):
+        path = filedialog.asksaveasfilename(
+            parent=self.mainwindow, defaultextension=".bin", 
+            filetypes=[("float32 samples", "*.bin")])
+        if path:
+            self.setspillfile(path)
+
+    def setspillfile(self, path):
+        self.spillpath = path
+        if self.readback != False:
+            self.readback.spillpath = path
+
+    def toggleanalysis(self):
+        if not self.analysisvar.get():
+            self.analysiswindow.window.withdraw()
+            return
+        if self.analysiswindow is None:
+            self.analysiswindow = Analysiswindow(self.mainwindow, 
+                                                 self.closeanalysis)
+        self.analysiswindow.window.deiconify()
+        self.startanalysis()
+
+    def closeanalysis(self):
+        self.analysisvar.set(False)
+        self.toggleanalysis()
+
+    def startanalysis(self):
+        if self.sentsettings is not None:
+            self.analysissettings = self.sentsettings
+            self.analysistitle = "Sent output"
+        else:
+            self.analysissettings = self.getsettings()
+            self.analysistitle = "Output in the window (not sent)"
+        # Raw output is analysed as the DAC codes of the device.
+        coefficients = None
+        if self.analysissettings["outputdata"] == "Raw int16":
+            try:
+                coefficients = self.daqout.scalingcoefficients()
+            except (AttributeError, nidaqmx.DaqError, RuntimeError):
+                # AttributeError: no DAQ is chosen yet.
+                self.analysistitle += ", scaled: no DAQ for the raw codes"
+        self.analysisfuture = self.analyzer.submitsettings(
+            self.analysissettings, self.waveformmatrix, self.cache, 
+            coefficients)
+        if not self.analysispending:
+            self.updateanalysis()
+
+    def updateanalysis(self):
+        """
+        Show the result when the analyzer is done, until then 
+        show how far it is a few times per second.
+        """
+        self.analysispending = False
+        future = self.analysisfuture
+        if future is None or not self.analysisvar.get():
+            return
+        if not future.done():
+            self.analysiswindow.status(
+                f"Analysing... {self.analyzer.progress*100:.0f} %")
+            self.analysispending = True
+            self.mainwindow.after(100, self.updateanalysis)
+            return
+        try:
+            result = future.result()
+        except Cancelled:
+            return
+        except (ValueError, MemoryError) as error:
+            self.analysiswindow.status(f"Could not analyse the output: {error}")
+            return
+        self.analysiswindow.show(result, [self.channel1var.get() or "Channel 1", 
+                                          self.channel2var.get() or "Channel 2"], 
+                                 self.analysistitle)
+
+    def updatereadback(self):
+        """
+        Draw the last captured period of the output on top of 
+        the plot. The samples are decimated to a few thousand 
+        points, so this stays fast at any sample rate.
+        """
+        if (self.readback != False and self.readback.ringbuffer is not None 
+                and self.readback.ringbuffer.total != self.readbacktotal):
+            self.readbacktotal = self.readback.ringbuffer.total
+            first, step, data = self.readback.latest(self.readbackperiod)
+            if data.shape[1] > 0:
+                for artist in self.readbackartists:
+                    artist.remove()
+                index = first + step*np.arange(data.shape[1])
+                x = (index % self.readbackperiod)/self.readback.sample_rate
+                self.readbackartists = [
+                    self.axs.scatter(x, y, s=0.3, color=color, alpha=0.5) 
+                    for y, color in zip(data, ["darkblue", "darkorange"])]
+                self.canvas.draw_idle()
+        self.mainwindow.after(250, self.updatereadback)
+
     def createsystemsettings(self):
         """
         This function creates the upper left frame which
@@ -301,12 +579,17 @@ class Mainwindow:
         samprlabel.grid(row=0, column=0, sticky="e")
         self.samprentry.grid(row=0, column=1, sticky="nsew")
 
+        # Shows the highest sample rate of the chosen channels.
+        self.maxratelbl = tk.Label(master=settingsframe, text="", font=FONT)
+        self.maxratelbl.grid(row=0, column=2, sticky="w")
+
 
         outputlabel = tk.Label(master=settingsframe, text="Output Type: ", 
                                font=FONT)
         self.outputvar = tk.StringVar()
         outputwavecombo = ttk.Combobox(settingsframe, 
-                                       values=("Continuous", "Finite"), 
+                                       values=("Continuous", "Finite", 
+                                               "Profile"), 
                                        textvariable=self.outputvar, 
                                        width=self.entrywidth, font=FONT)
         outputwavecombo['state'] = 'readonly'
@@ -332,6 +615,73 @@ class Mainwindow:
                              entry=self.amountentry:self.systemsettingsupdate(entry, 
                                                                               event))
 
+        # Raw output calculates the waveform in float32 and sends
+        # the DAC codes of the device as int16 to the DAQ.
+        datalabel = tk.Label(master=settingsframe, text="Output Data: ", 
+                             font=FONT)
+        self.datavar = tk.StringVar()
+        datacombo = ttk.Combobox(settingsframe, 
+                                 values=("Scaled float64", "Raw int16"), 
+                                 textvariable=self.datavar, 
+                                 width=self.entrywidth, font=FONT)
+        datacombo['state'] = 'readonly'
+        datacombo.set("Scaled float64")
+
+        datalabel.grid(row=3, column=0, sticky="e")
+        datacombo.grid(row=3, column=1, sticky="nsew")
+
+        # Hardware start trigger. With "Retriggerable" every edge
+        # sends the finite output again.
+        triggerlabel = tk.Label(master=settingsframe, text="Start Trigger: ", 
+                                font=FONT)
+        self.triggervar = tk.StringVar()
+        triggercombo = ttk.Combobox(settingsframe, 
+                                    values=("Software", "Digital Edge", 
+                                            "Retriggerable"), 
+                                    textvariable=self.triggervar, 
+                                    width=self.entrywidth, font=FONT)
+        triggercombo['state'] = 'readonly'
+        triggercombo.set("Software")
+
+        triggerlabel.grid(row=4, column=0, sticky="e")
+        triggercombo.grid(row=4, column=1, sticky="nsew")
+
+        terminallist = []
+        try:
+            for device in nidaqmx.system.System.local().devices:
+                terminallist += [terminal for terminal in device.terminals 
+                                 if "PFI" in terminal]
+        except:
+            pass
+        sourcelabel = tk.Label(master=settingsframe, text="Trigger Source: ", 
+                               font=FONT)
+        self.triggersourcevar = tk.StringVar()
+        self.sourcecombo = ttk.Combobox(settingsframe, values=terminallist, 
+                                        textvariable=self.triggersourcevar, 
+                                        width=self.entrywidth, font=FONT)
+        self.defaultsource = terminallist[0] if len(terminallist) > 0 else ""
+        self.sourcecombo.set(self.defaultsource)
+
+        sourcelabel.grid(row=5, column=0, sticky="e")
+        self.sourcecombo.grid(row=5, column=1, sticky="nsew")
+
+        edgelabel = tk.Label(master=settingsframe, text="Trigger Edge: ", 
+                             font=FONT)
+        self.triggeredgevar = tk.StringVar()
+        self.edgecombo = ttk.Combobox(settingsframe, 
+                                      values=("Rising", "Falling"), 
+                                      textvariable=self.triggeredgevar, 
+                                      width=self.entrywidth, font=FONT)
+        self.edgecombo['state'] = 'readonly'
+        self.edgecombo.set("Rising")
+
+        edgelabel.grid(row=6, column=0, sticky="e")
+        self.edgecombo.grid(row=6, column=1, sticky="nsew")
+        self.triggerupdate()
+
+        triggercombo.bind("<<ComboboxSelected>>", 
+                          lambda event: self.triggerupdate(event))
+
     def createchanneloptions(self, title_text, row_nr, column_nr, columnspan, 
                              waveformvar, entrylist, color):
         """
@@ -501,8 +851,45 @@ class Mainwindow:
         self.sendzerobtn.grid(row=10, column=0, sticky="nsew")
         self.sendzerobtn.config(state='disabled')
 
+        blankspace5 = tk.Label(master=outputframe, text="", font=FONT)
+        blankspace5.grid(row=11, column=0, sticky="w")
+
+        self.triggerlbl = tk.Label(master=outputframe, 
+                                   text="Trigger: Software", font=FONT)
+        self.triggerlbl.grid(row=12, column=0, sticky="w")
+
+    def triggerupdate(self, event=None):
+        if self.triggervar.get() == "Software":
+            self.sourcecombo.config(state=tk.DISABLED)
+            self.edgecombo.config(state=tk.DISABLED)
+        else:
+            self.sourcecombo.config(state=tk.NORMAL)
+            self.edgecombo.config(state="readonly")
+
+    def updatebursts(self):
+        """
+        Show how many bursts were fired by the trigger. The 
+        count comes from the samples the DAQ has generated, so
+        it does not need a callback per burst. A continuous
+        output has no bursts, so no count is shown.
+        """
+        try:
+            if (self.daqout != False and self.triggervar.get() != "Software"
+                    and self.outputindicator.cget("text") == "Output is on"):
+                try:
+                    bursts = self.daqout.burstsfired()
+                except (nidaqmx.DaqError, RuntimeError):
+                    # RuntimeError: the writer process stopped.
+                    bursts = "?"
+                text = f"Trigger: {self.daqout.triggersource}"
+                if bursts is not None:
+                    text += f", bursts fired: {bursts}"
+                self.triggerlbl.config(text=text)
+        finally:
+            self.mainwindow.after(200, self.updatebursts)
+
     def systemsettingsupdate(self, entry, event=None):
-        if self.outputvar.get() == "Continuous":
+        if self.outputvar.get() in ("Continuous", "Profile"):
             entry.config(state=tk.DISABLED)
         else:
             entry.config(state=tk.NORMAL)
@@ -524,55 +911,161 @@ class Mainwindow:
             self.entrylist2[1].config(state=tk.NORMAL)
 
         self.axs.clear()
-        if (self.outputvar.get() == "Finite" and 
-                self.waveformvars[0].get() == "Constant" and 
-                self.waveformvars[1].get() == "Constant"):
-            self.axs.scatter(*constructdcramp(float(self.samprentry.get()), 
-                                              float(self.rampentry.get()), 
-                                              float(self.dctime1entry.get()), 
-                                              float(self.entrylist1[2].get()), 0), 
-                                              s=0.3)
-            self.axs.scatter(*constructdcramp(float(self.samprentry.get()), 
-                                              float(self.rampentry.get()), 
-                                              float(self.dctime2entry.get()), 
-                                              float(self.entrylist2[2].get()), 
-                                              float(self.delayentry.get())), 
-                                              s=0.3)
+        self.readbackartists = []
+        self.readbacktotal = 0
+        self.previewsettings = self.getsettings()
+        if isdcramp(self.previewsettings) or isprofile(self.previewsettings):
+            pulselength = (outputlength(self.previewsettings)
+                           / self.previewsettings["samplerate"])
+        elif self.previewsettings["freq1"] > self.previewsettings["freq2"]:
+            pulselength = 1/self.previewsettings["freq2"]
         else:
-            waveformvalue1 = self.waveformdict[self.waveformvars[0].get()]
-            skiprate1 = (float(self.entrylist1[1].get()) 
-                         * len(self.time_axis)
-                         / float(self.samprentry.get()))
-            ind1 = ((np.arange(len(self.time_axis)) * skiprate1) 
-                     % len(self.time_axis)).astype(int)
-            xnow1 = self.time_axis*skiprate1 / (float(self.entrylist1[1].get()))
-            self.axs.scatter(xnow1,float(self.entrylist1[0].get()) 
-                                   * self.waveformmatrix[waveformvalue1,ind1] 
-                                   + float(self.entrylist1[2].get()), s = 0.3)
-
-            waveformvalue2 = self.waveformdict[self.waveformvars[1].get()]
-            skiprate2 = (float(self.entrylist2[1].get())
-                         * len(self.time_axis)
-                         / float(self.samprentry.get()))
-            ind2 = ((np.arange(len(self.time_axis)) * skiprate2) 
-                     % len(self.time_axis)).astype(int)
-            xnow2 = self.time_axis*skiprate2 / (float(self.entrylist2[1].get()))
-            y2 = (float(self.entrylist2[0].get())
-                  * self.waveformmatrix[waveformvalue2,ind2] 
-                  + float(self.entrylist2[2].get()))
-            self.axs.scatter(xnow2,
-                             np.roll(y2,int(float(self.samprentry.get())
-                                            * float(self.delayentry.get()))), s=0.3)
-            
-            if float(self.entrylist1[1].get()) > float(self.entrylist2[1].get()):
-                pulselength = 1/float(self.entrylist2[1].get())
-            else:
-                pulselength = 1/float(self.entrylist1[1].get())
-        
-            self.axs.set_xlim(0-0.05*pulselength, pulselength+0.05*pulselength)
+            pulselength = 1/self.previewsettings["freq1"]
+        xlim = (0-0.05*pulselength, pulselength+0.05*pulselength)
+
+        # Only the visible part of the output is calculated, see
+        # updatepreview for zooming and panning.
+        timer = Stagetimer()
+        points = self.previewpoints()
+        t, y = self.pipeline.preview(self.previewsettings, *xlim, points, 
+                                     timer)
+        self.previewartists = [self.axs.scatter(t, y[0], s=0.3), 
+                               self.axs.scatter(t, y[1], s=0.3)]
+        self.axs.set_xlim(*xlim)
+        # Clearing the axes also removes the callbacks.
+        self.axs.callbacks.connect("xlim_changed", self.previewzoomed)
         self.axs.set_xlabel('Time [s]')
         self.axs.set_ylabel('Amplitude [V]')
-        self.canvas.draw()
+        with timer.stage("draw"):
+            self.canvas.draw()
+        self.journal.recordsettings(self.previewsettings, "plot", 
+                                    timer.timings, xlim=xlim, points=points)
+
+    def previewpoints(self):
+        return max(200, self.canvas.get_tk_widget().winfo_width())
+
+    def previewzoomed(self, axs=None):
+        # While panning the limits change many times per redraw,
+        # so the new samples are only calculated once per idle.
+        if not self.previewpending:
+            self.previewpending = True
+            self.mainwindow.after_idle(self.updatepreview)
+
+    def updatepreview(self):
+        self.previewpending = False
+        tstart, tstop = self.axs.get_xlim()
+        timer = Stagetimer()
+        points = self.previewpoints()
+        t, y = self.pipeline.preview(self.previewsettings, tstart, tstop, 
+                                     points, timer)
+        self.journal.record("zoom", timer.timings, xlim=[tstart, tstop], 
+                            points=points)
+        for artist, row in zip(self.previewartists, y):
+            artist.set_offsets(np.column_stack((t, row)))
+        self.canvas.draw_idle()
+
+    def scrollzoom(self, event):
+        """
+        Zoom in and out on the time axis with the scroll wheel,
+        around the position of the mouse.
+        """
+        if event.inaxes != self.axs or event.xdata is None:
+            return
+        factor = 0.8 if event.button == "up" else 1.25
+        tstart, tstop = self.axs.get_xlim()
+        self.axs.set_xlim(event.xdata - (event.xdata-tstart)*factor, 
+                          event.xdata + (tstop-event.xdata)*factor)
+
+    def getsettings(self):
+        """
+        Collect all the values of the user interface in a 
+        dictionary with the same keys as DEFAULTSETTINGS in
+        waveforms.py.
+        """
+        return {"samplerate": float(self.samprentry.get()),
+                "output": self.outputvar.get(),
+                "amount": int(float(self.amountentry.get())),
+                "waveform1": self.waveformvars[0].get(),
+                "amp1": float(self.entrylist1[0].get()),
+                "freq1": float(self.entrylist1[1].get()),
+                "offs1": float(self.entrylist1[2].get()),
+                "waveform2": self.waveformvars[1].get(),
+                "amp2": float(self.entrylist2[0].get()),
+                "freq2": float(self.entrylist2[1].get()),
+                "offs2": float(self.entrylist2[2].get()),
+                "delay": float(self.delayentry.get()),
+                "ramptime": float(self.rampentry.get()),
+                "dctime1": float(self.dctime1entry.get()),
+                "dctime2": float(self.dctime2entry.get()),
+                "profile": self.profile,
+                "outputdata": self.datavar.get(),
+                "trigger": self.triggervar.get(),
+                "triggersource": self.triggersourcevar.get(),
+                "triggeredge": self.triggeredgevar.get()}
+
+    def setsettings(self, settings):
+        """
+        Put the values of a settings dictionary in the user 
+        interface, this is the opposite of getsettings.
+        """
+        def insertvalue(entry, value):
+            if float(value).is_integer():
+                value = int(value)
+            entry.config(state=tk.NORMAL)
+            entry.delete(0, tk.END)
+            entry.insert(0, value)
+
+        self.outputvar.set(settings["output"])
+        self.profile = settings.get("profile")
+        self.waveformvars[0].set(settings["waveform1"])
+        self.waveformvars[1].set(settings["waveform2"])
+        insertvalue(self.samprentry, settings["samplerate"])
+        insertvalue(self.amountentry, settings["amount"])
+        for entry, name in zip(self.entrylist1, ["amp1", "freq1", "offs1"]):
+            insertvalue(entry, settings[name])
+        for entry, name in zip(self.entrylist2, ["amp2", "freq2", "offs2"]):
+            insertvalue(entry, settings[name])
+        insertvalue(self.delayentry, settings["delay"])
+        insertvalue(self.rampentry, settings["ramptime"])
+        insertvalue(self.dctime1entry, settings["dctime1"])
+        insertvalue(self.dctime2entry, settings["dctime2"])
+        self.datavar.set(settings["outputdata"])
+        self.triggervar.set(settings["trigger"])
+        # Without a source the first terminal of the DAQ is chosen.
+        self.triggersourcevar.set(settings["triggersource"] 
+                                  or self.defaultsource)
+        self.triggeredgevar.set(settings["triggeredge"])
+        self.triggerupdate()
+        # This also disables the entries that are not used.
+        self.systemsettingsupdate(self.amountentry)
+
+    def savepreset(self):
+        name = simpledialog.askstring("Save preset", "Preset name:", 
+                                      parent=self.mainwindow)
+        if not name:
+            return
+        try:
+            self.presetstore.save(name, self.getsettings(), 
+                                  self.waveformmatrix)
+        except (OSError, ValueError) as error:
+            messagebox.showerror('Preset error', 
+                                 f'Error: Could not save preset: {error}')
+
+    def loadpreset(self, name):
+        self.setsettings(self.presetstore.load(name))
+
+    def deletepreset(self, name):
+        if messagebox.askyesno('Delete preset', f'Delete preset "{name}"?'):
+            self.presetstore.delete(name)
+
+    def updatepresetmenus(self):
+        self.loadpresetmenu.delete(0, tk.END)
+        self.deletepresetmenu.delete(0, tk.END)
+        for name in self.presetstore.names():
+            self.loadpresetmenu.add_command(
+                label=name, command=lambda name=name: self.loadpreset(name))
+            self.deletepresetmenu.add_command(
+                label=name, command=lambda name=name: self.deletepreset(name))
 
     def sendsignal(self):
         amp1 = self.entrylist1[0].get()
@@ -582,6 +1075,25 @@ class Mainwindow:
         freq2 = self.entrylist2[1].get()
         offs2 = self.entrylist2[2].get()
         samplerate = self.samprentry.get()
+
+        # The output is checked against the device before anything
+        # is changed, so a wrong setting does not stop the output.
+        settings = self.getsettings()
+        timer = Stagetimer()
+        readback = None
+        if self.readback != False and self.readbackvar.get():
+            readback = self.readback
+        plan = self.pipeline.send(settings, timer, readback)
+        if len(plan["problems"]) > 0:
+            self.journal.recordsettings(settings, "send", timer.timings, 
+                                        problems=plan["problems"])
+            messagebox.showerror('Output error', "\n".join(plan["problems"]))
+            return
+        self.journal.recordsettings(settings, "send", timer.timings, 
+                                    stream=plan["route"] == "Stream")
+        self.sentsettings = settings
+        self.readbackperiod = plan["length"]
+
         if self.waveformvars[0].get() == "Constant":
             txtoutputchannel1 = (f"Waveform:\t\t{self.waveformvars[0].get()}\n"
                                  f"Offset:\t\t{offs1} V")
@@ -598,6 +1110,15 @@ class Mainwindow:
                                  f"Amplitude:\t\t{amp2} V\n"
                                  f"Frequency:\t\t{freq2} Hz\n"
                                  f"Offset:\t\t{offs2} V")
+        if isprofile(settings):
+            profile = settings["profile"] or {}
+            segments1 = len(profile.get("channel1") or [])
+            segments2 = len(profile.get("channel2") or [])
+            length = plan["length"]/float(samplerate)
+            txtoutputchannel1 = (f"Profile:\t\t{segments1} segments\n"
+                                 f"Length:\t\t{length:g} s")
+            txtoutputchannel2 = (f"Profile:\t\t{segments2} segments\n"
+                                 f"Length:\t\t{length:g} s")
         self.outputchan1lbl.configure(state=tk.NORMAL)
         self.outputchan1lbl.delete(1.0,tk.END)
         self.outputchan1lbl.insert(tk.END,txtoutputchannel1)
@@ -608,82 +1129,41 @@ class Mainwindow:
         self.outputchan2lbl.configure(state=tk.DISABLED)
 
         self.outputindicator.config(text="Output is on", fg="green")
-
-        if (self.outputvar.get() == "Finite" and 
-                self.waveformvars[0].get() == "Constant" and 
-                self.waveformvars[1].get() == "Constant"):
-            time1, y1 = constructdcramp(float(samplerate), 
-                                        float(self.rampentry.get()), 
-                                        float(self.dctime1entry.get()), 
-                                        float(offs1), 0)
-            time2, y2 = constructdcramp(float(samplerate), 
-                                        float(self.rampentry.get()), 
-                                        float(self.dctime2entry.get()), 
-                                        float(offs2), 
-                                        float(self.delayentry.get()))
-            if len(y2) > len(y1):
-                outputsignal = np.vstack((np.hstack((y1, np.zeros(len(y2)-len(y1))))
-                                          , y2))
-            elif len(y2) < len(y1):
-                outputsignal = np.vstack((y1, 
-                                          np.hstack((y2, np.zeros(len(y1)-len(y2))))))
-            else:
-                outputsignal = np.vstack((y1, y2))
-        
-            self.daqout.pausefunc()
-            self.daqout.sample_rate = int(samplerate)
-            self.daqout.singleoutput(outputsignal)
-
-        elif self.outputvar.get() == "Finite":
-            x1 = np.arange(0, 1/float(freq1), 1/(int(samplerate)))
-            y1 = returnfinite(x1, self.waveformvars[0].get(), float(freq1))
-            if self.waveformvars[1].get() == "Constant":
-                y2 = np.zeros(len(y1), dtype=float)
-            x2 = np.arange(0, 1/float(freq2), 1/(int(samplerate)))
-            y2 = returnfinite(x2, self.waveformvars[1].get(), float(freq2))
-            ynew1 = y1
-            ynew2 = y2
-            for i in range(int(self.amountentry.get())-1):
-                ynew1 = np.hstack((ynew1, y1))
-                ynew2 = np.hstack((ynew2, y2))
-
-            ynew1 = np.hstack((ynew1, [0]))
-            ynew2 = np.roll(ynew2, int(float(samplerate)
-                                       * float(self.delayentry.get())))
-            ynew2 = np.hstack((ynew2, [0]))
-
-            outputsignal = np.vstack((ynew1, ynew2))
-            self.daqout.pausefunc()
-            self.daqout.sample_rate = int(samplerate)
-            self.daqout.singleoutput(outputsignal)
-
-
+        if settings["trigger"] == "Software":
+            self.triggerlbl.config(text="Trigger: Software")
         else:
-            waveformvalue1 = self.waveformdict[self.waveformvars[0].get()]
-            skiprate1 = (float(freq1)*len(self.time_axis)/float(samplerate))
-            ind1 = ((np.arange(len(self.time_axis))*skiprate1) 
-                     % len(self.time_axis)).astype(int)
-            waveformout = (float(amp1)*self.waveformmatrix[waveformvalue1,ind1] 
-                           + float(offs1))
-
-            waveformvalue2 = self.waveformdict[self.waveformvars[1].get()]
-            skiprate2 = (float(freq2)*len(self.time_axis)/float(samplerate))
-            ind2 = ((np.arange(len(self.time_axis))*skiprate2) 
-                     % len(self.time_axis)).astype(int)
-            waveformout = np.vstack((waveformout, 
-                                     np.roll(float(amp2) 
-                                     * self.waveformmatrix[waveformvalue2,ind2] 
-                                     + float(offs2), 
-                                     int(float(samplerate)
-                                     * float(self.delayentry.get())))))
-
-            self.daqout.pausefunc()
-            self.daqout.sample_rate = int(samplerate)
-            self.daqout.outputcontinuously(waveformout)
+            text = f"Trigger: {settings['triggersource']}"
+            if plan["mode"] != "Continuous":
+                text += ", bursts fired: 0"
+            self.triggerlbl.config(text=text)
+        if self.analysisvar.get():
+            self.startanalysis()
 
     def callback(self, task_handle, status, callback_data):
+        """
+        Done event of the output task. It comes from another
+        thread, so the widgets are changed by outputdone on the
+        main thread.
+        """
         print(f"Stopped with status {status}")
+        self.journal.record("done", status=status)
         self.daqout.task.stop()
+        self.doneevents.put(status)
+        return 0
+
+    def checkdone(self):
+        try:
+            while True:
+                self.doneevents.get_nowait()
+                self.outputdone()
+        except queue.Empty:
+            pass
+        finally:
+            self.mainwindow.after(100, self.checkdone)
+
+    def outputdone(self):
+        if self.readback != False:
+            self.readback.stop()
         self.outputchan1lbl.configure(state=tk.NORMAL)
         self.outputchan1lbl.delete(1.0,tk.END)
         self.outputchan1lbl.insert(tk.END,"Output is off")
@@ -693,22 +1173,32 @@ class Mainwindow:
         self.outputchan2lbl.insert(tk.END,"Output is off")
         self.outputchan2lbl.configure(state=tk.DISABLED)
         self.outputindicator.config(text="Output is off", fg="red")
-        return 0
 
     def defaultsettings(self):
-        print("Does not work yet")
+        self.setsettings(DEFAULTSETTINGS)
        
     def quit_me(self):
         print('Closing the program')
         self.mainwindow.quit()
         self.mainwindow.destroy()
+        if self.readback != False:
+            self.readback.stop()
         if self.daqout != False:
             self.daqout.stopfunc()
             print("Stopped DAQ output")
+        self.pipeline.close()
+        self.generator.shutdown()
+        self.analyzer.shutdown()
+        self.journal.record("quit")
+        self.journal.close()
 
     def stopoutput(self):
-        self.daqout.pausefunc()
-        self.daqout.outputcontinuously(np.zeros((2, 10), dtype=float))
+        if self.readback != False:
+            self.readback.stop()
+        timer = Stagetimer()
+        self.pipeline.stop(timer)
+        self.journal.record("stop", timer.timings)
+        self.sentsettings = None
         self.outputchan1lbl.configure(state=tk.NORMAL)
         self.outputchan1lbl.delete(1.0,tk.END)
         self.outputchan1lbl.insert(tk.END,"Output is off")
@@ -0,0 +1,235 @@
+""" nidaqreader.py
+This file contains a Reader class that reads back the output of the
+AWG with the analog inputs of the DAQ. The input task uses the sample
+clock and the start trigger of the output task, so every input sample
+belongs to exactly one output sample. The samples are read on a
+separate thread and kept in a ring buffer with a fixed size, so the
+memory does not grow however long the output runs. Optionally every
+chunk is also written to a file on disk, a new file for every capture
+with the amount of channels and the sample rate in its name.
+"""
+
+
+import glob
+import os
+import threading
+import time
+
+import numpy as np
+import nidaqmx
+from nidaqmx import stream_readers
+import nidaqmx.constants as nico
+
+
+__author__ = "Jaimy Plugge"
+
+
+class Ringbuffer:
+    """
+    Keeps the last <capacity> samples of every channel. The
+    total amount of written samples is counted, so the index
+    of a sample since the start of the output is known.
+    """
+    def __init__(self, channels, capacity):
+        self.capacity = int(capacity)
+        self.data = np.zeros((channels, self.capacity), dtype=np.float32)
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def write(self, chunk):
+        samples = chunk.shape[1]
+        with self.lock:
+            if samples > self.capacity:
+                self.total += samples-self.capacity
+                chunk = chunk[:,-self.capacity:]
+                samples = self.capacity
+            start = self.total % self.capacity
+            first = min(samples, self.capacity-start)
+            self.data[:,start:start+first] = chunk[:,:first]
+            self.data[:,:samples-first] = chunk[:,first:]
+            self.total += samples
+
+    def latest(self, samples):
+        """
+        Return the index of the first sample and a copy of the
+        last <samples> samples.
+        """
+        with self.lock:
+            samples = min(int(samples), self.total, self.capacity)
+            end = self.total % self.capacity
+            if end >= samples:
+                data = self.data[:,end-samples:end].copy()
+            else:
+                data = np.hstack((self.data[:,self.capacity-(samples-end):],
+                                  self.data[:,:end]))
+            return self.total-samples, data
+
+
+def decimate(data, points):
+    """
+    Take every n-th sample so that about <points> samples are
+    left, which is plenty for the plot window.
+    """
+    step = max(1, int(np.ceil(data.shape[1]/points)))
+    return step, data[:,::step]
+
+
+class Reader:
+    def __init__(self, chan_names, capacity=10, chunktime=0.05,
+                 spillpath=None):
+        """
+        chan_names are the analog input channels, capacity is
+        the length of the ring buffer in seconds and chunktime
+        the time between two reads.
+        """
+        self.chan_names = [name for name in chan_names if len(name) > 0]
+        self.capacitytime = capacity
+        self.chunktime = chunktime
+        self.spillpath = spillpath
+        self.sample_rate = 1
+        self.ringbuffer = None
+        self.task = None
+        self.thread = None
+        self.stopevent = threading.Event()
+
+    def start(self, sample_rate, ao_chan_name):
+        """
+        Arm the input task. It starts together with the output
+        task of ao_chan_name, so this has to be called before
+        the output is started.
+        """
+        self.stop()
+        self.sample_rate = sample_rate
+        self.chunksize = max(1, int(sample_rate*self.chunktime))
+        self.ringbuffer = Ringbuffer(len(self.chan_names),
+                                     sample_rate*self.capacitytime)
+        self.createtask(ao_chan_name.split("/")[0])
+        self.spillfile = None
+        if self.spillpath:
+            self.spillfile = open(self.spillname(), "xb")
+        self.stopevent.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def spillname(self):
+        """
+        Return the name of the file for the next capture: the
+        chosen name with a number that is not used yet, the
+        amount of channels and the sample rate, for example
+        capture-003-2ch-10000Sps.bin.
+        """
+        root, extension = os.path.splitext(self.spillpath)
+        number = 1
+        while glob.glob(f"{glob.escape(root)}-{number:03d}-*"):
+            number += 1
+        return (f"{root}-{number:03d}-{len(self.chan_names)}ch-"
+                f"{self.sample_rate:g}Sps{extension}")
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopevent.set()
+            self.thread.join()
+            self.thread = None
+        if self.task is not None:
+            self.closetask()
+            self.task = None
+
+    def run(self):
+        chunk = np.zeros((len(self.chan_names), self.chunksize), dtype=float)
+        while not self.stopevent.is_set():
+            if self.available() < self.chunksize:
+                self.stopevent.wait(self.chunktime/4)
+                continue
+            self.readinto(chunk)
+            self.store(chunk)
+        # Read the samples that are left after the output stopped.
+        available = self.available()
+        if available > 0:
+            rest = np.zeros((len(self.chan_names), available), dtype=float)
+            self.readinto(rest)
+            self.store(rest)
+        if self.spillfile is not None:
+            self.spillfile.close()
+
+    def store(self, chunk):
+        self.ringbuffer.write(chunk)
+        if self.spillfile is not None:
+            # One row per sample, so the file can be read with
+            # np.fromfile(path, np.float32).reshape(-1, channels).
+            chunk.T.astype(np.float32).tofile(self.spillfile)
+
+    def latest(self, samples, points=2000):
+        """
+        Return the index of the first sample, the step between
+        the samples and the decimated last <samples> samples.
+        """
+        if self.ringbuffer is None:
+            return 0, 1, np.zeros((len(self.chan_names), 0))
+        first, data = self.ringbuffer.latest(samples)
+        step, data = decimate(data, points)
+        return first, step, data
+
+    def createtask(self, device):
+        self.task = nidaqmx.Task()
+        for chan_name in self.chan_names:
+            self.task.ai_channels.add_ai_voltage_chan(chan_name)
+        self.task.timing.cfg_samp_clk_timing(rate=self.sample_rate,
+                                             source=f"/{device}/ao/SampleClock",
+                                             sample_mode=nico.AcquisitionType.CONTINUOUS,
+                                             samps_per_chan=self.chunksize)
+        self.task.triggers.start_trigger.cfg_dig_edge_start_trig(
+            f"/{device}/ao/StartTrigger")
+        # Room for a second of samples, so a slow read does not
+        # overwrite the driver buffer.
+        self.task.in_stream.input_buf_size = max(int(self.sample_rate),
+                                                 4*self.chunksize)
+        self.streamreader = stream_readers.AnalogMultiChannelReader(
+            self.task.in_stream)
+        self.task.start()
+
+    def available(self):
+        return self.task.in_stream.avail_samp_per_chan
+
+    def readinto(self, data):
+        self.streamreader.read_many_sample(data, data.shape[1], timeout=0)
+
+    def closetask(self):
+        self.task.close()
+
+
+class Simreader(Reader):
+    """
+    Simulated version of the Reader that reads back the last
+    output of a Simwriter, at the speed of the sample rate.
+    """
+    def __init__(self, chan_names, simwriter, noise=1E-3, **kwargs):
+        super().__init__(chan_names, **kwargs)
+        self.simwriter = simwriter
+        self.noise = noise
+
+    def createtask(self, device):
+        self.task = "simulated"
+        self.starttime = None
+        self.readsamples = 0
+
+    def available(self):
+        if not self.simwriter.task.running and self.starttime is None:
+            return 0
+        if self.starttime is None:
+            self.starttime = time.perf_counter()
+        elapsed = int((time.perf_counter()-self.starttime)*self.sample_rate)
+        if self.simwriter.task.finite_samples > 0:
+            elapsed = min(elapsed, self.simwriter.task.finite_samples)
+        return elapsed-self.readsamples
+
+    def readinto(self, data):
+        output = np.asarray(self.simwriter.lastoutput, dtype=float)
+        index = np.arange(self.readsamples, self.readsamples+data.shape[1])
+        rows = min(data.shape[0], output.shape[0])
+        data[:] = 0
+        data[:rows] = output[:rows, index % output.shape[1]]
+        data += self.noise*np.random.standard_normal(data.shape)
+        self.readsamples += data.shape[1]
+
+    def closetask(self):
+        pass
@@ -2,10 +2,13 @@
 This file contains a Writer class that uses nidaqmx to communicate with 
 NI DAQs that are capable of outputting a voltage. This module was 
 especially tested on a NI myDAQ, but should also work on other output 
-DAQs.
+DAQs. The Simwriter class has the same methods, but does not need a
+DAQ, so the rest of the program can be tried out without hardware.
 """
 
 
+import threading
+
 import numpy as np
 import nidaqmx
 from nidaqmx import stream_writers
@@ -15,9 +18,25 @@ import nidaqmx.constants as nico
 __author__ = "Jaimy Plugge"
 
 
+# Largest buffer that is given to the driver at once, longer outputs
+# have to be streamed.
+MAXBUFFERBYTES = 2**31
+
+
 class Writer: 
-    def __init__(self, chan_name1, chan_name2, sample_rate):
+    def __init__(self, chan_name1, chan_name2, sample_rate, rawoutput=False):
         self.sample_rate = sample_rate
+        self.rawoutput = rawoutput
+        self.coefficients = None
+        self.streamthread = None
+        self.streamstop = threading.Event()
+        # Start trigger, an empty source means a software start.
+        self.triggersource = ""
+        self.triggeredge = "Rising"
+        self.retriggerable = False
+        self.retriggerset = False
+        self.burstsamples = 0
+        self.devicecapabilities = None
         self.chan_name1 = chan_name1
         self.chan_name2 = chan_name2
         self.task = nidaqmx.Task()
@@ -26,9 +45,14 @@ class Writer:
         if len(self.chan_name2) > 0:
             self.multichan = True
             self.task.ao_channels.add_ao_voltage_chan(self.chan_name2)
+        # Read before any output, see capabilities.
+        self.capabilities()
 
     def changetask(self, new_chan_name1, new_chan_name2):
         self.stopfunc()
+        self.coefficients = None
+        self.retriggerset = False
+        self.devicecapabilities = None
         self.chan_name1 = new_chan_name1
         self.chan_name2 = new_chan_name2
         self.task = nidaqmx.Task()
@@ -37,40 +61,503 @@ class Writer:
         if len(self.chan_name2) > 0:
             self.multichan = True
             self.task.ao_channels.add_ao_voltage_chan(self.chan_name2)
+        # Read before any output, see capabilities.
+        self.capabilities()
        
-    def outputcontinuously(self, waveform):
+    def outputcontinuously(self, waveform, trigger=True):
         self.task.timing.cfg_samp_clk_timing(rate= self.sample_rate,
                                              source="OnboardClock", 
                                              sample_mode= nico.AcquisitionType.CONTINUOUS, 
                                              samps_per_chan= 10)
-        if self.multichan:
-            test_Writer = stream_writers.AnalogMultiChannelWriter(self.task.out_stream, 
-                                                                  auto_start=False)
-            test_Writer.write_many_sample(waveform, timeout=nico.WAIT_INFINITELY)
-        else:    
-            test_Writer = stream_writers.AnalogSingleChannelWriter(self.task.out_stream, 
-                                                                   auto_start=False)
-            test_Writer.write_many_sample(waveform[0,:], timeout=nico.WAIT_INFINITELY)
+        self.applyplan(self.planoutput(self.sample_rate, waveform.shape[1], 
+                                       "Continuous", 
+                                       trigger and self.retriggering(), 
+                                       self.writesraw(waveform)))
+        self.configuretrigger(trigger, retriggerable=False)
+        self.burstsamples = 0
+        self.writesamples(waveform, timeout=nico.WAIT_INFINITELY)
         self.task.start()
 
     def singleoutput(self, samples):
+        """
+        Send the samples once. With a retriggerable start 
+        trigger the buffer is written once and every edge on
+        the trigger source sends all samples again, without 
+        anything being done in Python.
+        """
         self.task.timing.cfg_samp_clk_timing(rate=self.sample_rate, 
                                              sample_mode= nico.AcquisitionType.FINITE, 
                                              samps_per_chan= samples.shape[1])
-        if self.multichan:
+        self.applyplan(self.planoutput(self.sample_rate, samples.shape[1], 
+                                       "Finite", 
+                                       rawoutput=self.writesraw(samples)))
+        self.configuretrigger(True, retriggerable=self.retriggerable)
+        self.burstsamples = samples.shape[1]
+        self.writesamples(samples)
+        self.task.start()
+
+    def capabilities(self):
+        """
+        Ask the device what it can do with the channels of this
+        task: the highest and lowest sample rate and the size of
+        the onboard memory (FIFO) in samples per channel. They
+        are read when the task is made, because the timing of
+        the task is changed to read them.
+        """
+        if self.devicecapabilities is None:
+            device = nidaqmx.system.Device(self.chan_name1.split("/")[0])
+            self.devicecapabilities = {"maxrate": device.ao_max_rate,
+                                       "minrate": device.ao_min_rate,
+                                       "onboardbuffer": 0}
+            try:
+                # The rate of the task takes the amount of channels
+                # into account, the rate of the device does not.
+                self.task.timing.cfg_samp_clk_timing(
+                    rate=self.devicecapabilities["minrate"],
+                    sample_mode=nico.AcquisitionType.CONTINUOUS)
+                self.devicecapabilities["maxrate"] = self.task.timing.samp_clk_max_rate
+                self.devicecapabilities["onboardbuffer"] = self.task.out_stream.output_onbrd_buf_size
+            except nidaqmx.DaqError:
+                pass
+        return self.devicecapabilities
+
+    def retriggering(self):
+        """
+        Return whether the next output gets a retriggerable 
+        start trigger.
+        """
+        return self.retriggerable and len(self.triggersource) > 0
+
+    def writesraw(self, samples):
+        """
+        Return whether the samples are written as int16 codes.
+        """
+        return self.rawoutput or samples.dtype == np.int16
+
+    def planoutput(self, sample_rate, samples, outputmode, 
+                   retriggerable=False, rawoutput=None):
+        """
+        Check an output before it is sent and choose how the 
+        samples go to the device. outputmode is "Continuous", 
+        "Finite" or "Stream" (see streamoutput). The problems 
+        in the returned plan are the reasons the output would 
+        fail, an empty list means it can be sent. Only a finite
+        output that is written at once can be retriggered. The
+        buffer is int16 with rawoutput and float64 otherwise,
+        without rawoutput self.rawoutput is used.
+
+        When the buffer fits in the onboard memory of the device
+        and is regenerated, it is only sent once and the device
+        repeats it on its own. Otherwise the samples are sent 
+        while the output runs; at high rates the FIFO is kept as
+        full as possible, at low rates fewer and bigger transfers
+        are made.
+        """
+        capabilities = self.capabilities()
+        channels = 2 if self.multichan else 1
+        problems = []
+        if sample_rate > capabilities["maxrate"]:
+            problems.append(f"The sample rate of {sample_rate:g} S/s is higher "
+                            f"than the {capabilities['maxrate']:g} S/s the "
+                            f"device can do with {channels} channel(s).")
+        if sample_rate < capabilities["minrate"]:
+            problems.append(f"The sample rate of {sample_rate:g} S/s is lower "
+                            f"than the {capabilities['minrate']:g} S/s of the "
+                            f"device.")
+        if samples < 2:
+            problems.append("The output needs at least 2 samples.")
+        if rawoutput is None:
+            rawoutput = self.rawoutput
+        itemsize = 2 if rawoutput else 8
+        if (outputmode != "Stream" and 
+                samples*channels*itemsize > MAXBUFFERBYTES):
+            problems.append(f"The output of {samples} samples does not fit in "
+                            f"the buffer of the driver.")
+        if retriggerable and outputmode != "Finite":
+            problems.append(f"A {outputmode.lower()} output can not be "
+                            f"retriggered, only a finite output that fits in "
+                            f"the buffer of the driver.")
+        useonboard = (outputmode != "Stream" and 
+                      0 < samples <= capabilities["onboardbuffer"])
+        if sample_rate > capabilities["maxrate"]/10:
+            transfercondition = nico.OutputDataTransferCondition.ON_BOARD_MEMORY_LESS_THAN_FULL
+        else:
+            transfercondition = nico.OutputDataTransferCondition.ON_BOARD_MEMORY_HALF_FULL_OR_LESS
+        return {"sample_rate": sample_rate,
+                "maxrate": capabilities["maxrate"],
+                "onboardbuffer": capabilities["onboardbuffer"],
+                "useonboard": useonboard,
+                "transfercondition": transfercondition,
+                "problems": problems}
+
+    def applyplan(self, plan):
+        if len(plan["problems"]) > 0:
+            raise ValueError(" ".join(plan["problems"]))
+        for channel in self.task.ao_channels:
+            try:
+                channel.ao_use_only_on_brd_mem = plan["useonboard"]
+                channel.ao_data_xfer_req_cond = plan["transfercondition"]
+            except nidaqmx.DaqError:
+                # Not every device lets you choose this.
+                pass
+
+    def configuretrigger(self, trigger, retriggerable):
+        start_trigger = self.task.triggers.start_trigger
+        if trigger and len(self.triggersource) > 0:
+            if self.triggeredge == "Falling":
+                edge = nico.Edge.FALLING
+            else:
+                edge = nico.Edge.RISING
+            start_trigger.cfg_dig_edge_start_trig(self.triggersource, 
+                                                  trigger_edge=edge)
+        else:
+            start_trigger.disable_start_trig()
+            retriggerable = False
+        if retriggerable:
+            start_trigger.retriggerable = True
+            self.retriggerset = True
+        elif self.retriggerset:
+            del start_trigger.retriggerable
+            self.retriggerset = False
+
+    def burstsfired(self):
+        """
+        Return how many times the finite output was sent since
+        the task was started, or None for continuous output.
+        """
+        if self.burstsamples == 0:
+            return None
+        generated = self.task.out_stream.total_samp_per_chan_generated
+        return generated // self.burstsamples
+
+    def writesamples(self, samples, timeout=10.0):
+        """
+        Write the samples to the buffer of the task. With 
+        rawoutput the samples are converted to the DAC codes of 
+        the device and written with the unscaled writer, which 
+        saves the driver the conversion of the doubles. Samples 
+        that already are int16 are written as they are.
+        """
+        channels = 2 if self.multichan else 1
+        if self.writesraw(samples):
+            samples = self.rawsamples(samples)
+            test_Writer = stream_writers.AnalogUnscaledWriter(self.task.out_stream, 
+                                                              auto_start=False)
+            test_Writer.write_int16(np.ascontiguousarray(samples[:channels,:]), 
+                                    timeout=timeout)
+        elif self.multichan:
             test_Writer = stream_writers.AnalogMultiChannelWriter(self.task.out_stream, 
                                                                   auto_start=False)
-            test_Writer.write_many_sample(samples)
+            test_Writer.write_many_sample(np.ascontiguousarray(samples, 
+                                                               dtype=np.float64), 
+                                          timeout=timeout)
         else:    
             test_Writer = stream_writers.AnalogSingleChannelWriter(self.task.out_stream, 
                                                                    auto_start=False)
-            test_Writer.write_many_sample(samples[0,:])
+            test_Writer.write_many_sample(np.ascontiguousarray(samples[0,:], 
+                                                               dtype=np.float64), 
+                                          timeout=timeout)
+
+    def rawsamples(self, samples):
+        """
+        Return the samples as int16 DAC codes for the channels
+        of this task.
+        """
+        channels = 2 if self.multichan else 1
+        if samples.dtype == np.int16:
+            return samples[:channels,:]
+        return voltstoraw(samples[:channels,:], self.scalingcoefficients())
+
+    def scalingcoefficients(self):
+        """
+        Return the coefficients the device uses to go from volts 
+        to DAC codes, one list for every channel.
+        """
+        if self.coefficients is None:
+            self.coefficients = [list(channel.ao_dev_scaling_coeff) 
+                                 for channel in self.task.ao_channels]
+        return self.coefficients
+
+    def streamoutput(self, output, prefill=2):
+        """
+        Finite output of a Sharedoutput (see parallelgen.py) 
+        that may still be calculated. The first <prefill> chunks 
+        are written before the task is started and the rest is 
+        written on a thread as soon as every chunk is ready. The 
+        driver does not regenerate old samples, so its buffer 
+        only needs room for a few chunks. The writes of the
+        thread wait as long as it takes, because at low rates or
+        before a trigger the buffer can stay full for longer than
+        any fixed timeout; stopping the task ends the wait.
+        """
+        self.task.timing.cfg_samp_clk_timing(rate=self.sample_rate, 
+                                             sample_mode= nico.AcquisitionType.FINITE, 
+                                             samps_per_chan= output.length)
+        self.applyplan(self.planoutput(self.sample_rate, output.length, 
+                                       "Stream", self.retriggering()))
+        self.configuretrigger(True, retriggerable=False)
+        self.burstsamples = output.length
+        self.task.out_stream.regen_mode = nico.RegenerationMode.DONT_ALLOW_REGENERATION
+        self.task.out_stream.output_buf_size = min(output.length, 
+                                                   (prefill+2)*output.chunksize)
+        chunks = output.chunks()
+        for _, chunk in zip(range(prefill), chunks):
+            self.writesamples(chunk)
         self.task.start()
+        self.streamthread = threading.Thread(target=self.streamchunks, 
+                                             args=(chunks,), daemon=True)
+        self.streamthread.start()
+
+    def streamchunks(self, chunks):
+        try:
+            for chunk in chunks:
+                if self.streamstop.is_set():
+                    break
+                self.writesamples(chunk, timeout=nico.WAIT_INFINITELY)
+        except nidaqmx.DaqError as error:
+            if not self.streamstop.is_set():
+                print(f"Streaming stopped: {error}")
+
+    def stopstream(self):
+        if self.streamthread is not None:
+            self.streamstop.set()
+            self.streamthread.join()
+            self.streamthread = None
+            self.streamstop.clear()
+            # Back to the buffer settings of the other outputs.
+            del self.task.out_stream.regen_mode
+            del self.task.out_stream.output_buf_size
 
     def pausefunc(self):
+        # Tell the stream thread first, the write that is waiting
+        # ends with an error when the task stops.
+        self.streamstop.set()
         self.task.stop()
+        self.stopstream()
+        self.streamstop.clear()
 
     def stopfunc(self):
         self.pausefunc()
-        self.outputcontinuously(np.zeros((2, 10), dtype=float))
-        self.task.close()
\ No newline at end of file
+        self.outputcontinuously(np.zeros((2, 10), dtype=float), trigger=False)
+        self.task.close()
+
+
+def voltstoraw(samples, coefficients, chunksize=2**20):
+    """
+    Convert voltages to the int16 codes of the DAC with the 
+    polynomial scaling coefficients of every channel. The 
+    conversion is done in float32 and in chunks, so there is 
+    never a big float64 copy of the samples in memory. Values 
+    outside of the range of the DAC are clipped.
+    """
+    info = np.iinfo(np.int16)
+    raw = np.empty(samples.shape, dtype=np.int16)
+    work = np.empty(min(chunksize, samples.shape[1]), dtype=np.float32)
+    for channel in range(samples.shape[0]):
+        # Horner's method, highest order coefficient first.
+        coefficient = np.float32(coefficients[channel][-1])
+        lowerorders = [np.float32(c) for c in coefficients[channel][-2::-1]]
+        for start in range(0, samples.shape[1], chunksize):
+            chunk = samples[channel, start:start+chunksize]
+            out = work[:len(chunk)]
+            out.fill(coefficient)
+            for lowerorder in lowerorders:
+                np.multiply(out, chunk, out=out, casting="unsafe")
+                np.add(out, lowerorder, out=out)
+            np.rint(out, out=out)
+            np.clip(out, info.min, info.max, out=out)
+            raw[channel, start:start+chunksize] = out
+    return raw
+
+
+def rawtovolts(raw, coefficients, gridpoints=2**18):
+    """
+    Convert int16 DAC codes back to the voltages they stand for,
+    the inverse of voltstoraw. The polynomial is inverted by
+    interpolating it on a fine grid over the range of the DAC,
+    which is exact for the usual linear scaling.
+    """
+    info = np.iinfo(np.int16)
+    volts = np.empty(raw.shape, dtype=np.float32)
+    for channel in range(raw.shape[0]):
+        polynomial = np.polynomial.Polynomial(coefficients[channel])
+        # The range of the DAC follows from the linear part.
+        offset, gain = coefficients[channel][0], coefficients[channel][1]
+        low, high = sorted(((info.min-offset)/gain, (info.max-offset)/gain))
+        margin = 0.1*(high-low)
+        grid = np.linspace(low-margin, high+margin, gridpoints)
+        codes = polynomial(grid)
+        order = np.argsort(codes)
+        volts[channel] = np.interp(raw[channel], codes[order], grid[order])
+    return volts
+
+
+class Simtask:
+    """
+    Stand-in for nidaqmx.Task that is used by the Simwriter.
+    It only keeps track of the timing and calls the done
+    event after a finite output would have finished. With a
+    start trigger the output waits for a call to fire.
+    """
+    def __init__(self):
+        self.done_callbacks = []
+        self.finite_samples = 0
+        self.sample_rate = 1
+        self.running = False
+        self.timer = None
+        self.triggered = False
+        self.retriggerable = False
+        self.fired = False
+        self.generated = 0
+
+    def register_done_event(self, callback_method):
+        if callback_method is None:
+            self.done_callbacks = []
+        else:
+            self.done_callbacks.append(callback_method)
+
+    def start(self):
+        self.running = True
+        self.fired = False
+        self.generated = 0
+        if not self.triggered:
+            self.fire()
+
+    def fire(self):
+        if not self.running or (self.fired and not self.retriggerable):
+            return
+        self.fired = True
+        self.generated += self.finite_samples
+        if self.finite_samples > 0 and not self.retriggerable:
+            self.timer = threading.Timer(self.finite_samples/self.sample_rate, 
+                                         self.done)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def done(self):
+        self.running = False
+        for callback_method in self.done_callbacks:
+            callback_method(0, 0, None)
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.running = False
+
+    def close(self):
+        self.stop()
+
+
+class Simwriter(Writer):
+    """
+    Simulated version of the Writer class. It does not talk
+    to a DAQ, but remembers the last written samples in 
+    self.lastoutput so they can be checked.
+    """
+    def __init__(self, chan_name1, chan_name2, sample_rate, rawoutput=False):
+        self.sample_rate = sample_rate
+        self.rawoutput = rawoutput
+        self.coefficients = None
+        self.streamthread = None
+        self.streamstop = threading.Event()
+        self.triggersource = ""
+        self.triggeredge = "Rising"
+        self.retriggerable = False
+        self.burstsamples = 0
+        self.devicecapabilities = None
+        self.lastoutput = None
+        self.changetask(chan_name1, chan_name2)
+
+    def changetask(self, new_chan_name1, new_chan_name2):
+        if hasattr(self, "task"):
+            self.task.close()
+        self.chan_name1 = new_chan_name1
+        self.chan_name2 = new_chan_name2
+        self.task = Simtask()
+        self.multichan = len(self.chan_name2) > 0
+
+    def outputcontinuously(self, waveform, trigger=True):
+        self.applyplan(self.planoutput(self.sample_rate, waveform.shape[1], 
+                                       "Continuous", 
+                                       trigger and self.retriggering(), 
+                                       self.writesraw(waveform)))
+        self.task.sample_rate = self.sample_rate
+        self.task.finite_samples = 0
+        self.configuretrigger(trigger, retriggerable=False)
+        self.burstsamples = 0
+        self.writesamples(waveform)
+        self.task.start()
+
+    def singleoutput(self, samples):
+        self.applyplan(self.planoutput(self.sample_rate, samples.shape[1], 
+                                       "Finite", 
+                                       rawoutput=self.writesraw(samples)))
+        self.task.sample_rate = self.sample_rate
+        self.task.finite_samples = samples.shape[1]
+        self.configuretrigger(True, retriggerable=self.retriggerable)
+        self.burstsamples = samples.shape[1]
+        self.writesamples(samples)
+        self.task.start()
+
+    def capabilities(self):
+        # A myDAQ: 200 kS/s per channel and a FIFO of 8191 samples.
+        return {"maxrate": 200000, "minrate": 0.1, "onboardbuffer": 8191}
+
+    def applyplan(self, plan):
+        if len(plan["problems"]) > 0:
+            raise ValueError(" ".join(plan["problems"]))
+
+    def configuretrigger(self, trigger, retriggerable):
+        self.task.triggered = trigger and len(self.triggersource) > 0
+        self.task.retriggerable = self.task.triggered and retriggerable
+
+    def firetrigger(self):
+        """
+        Simulate an edge on the trigger source.
+        """
+        self.task.fire()
+
+    def burstsfired(self):
+        if self.burstsamples == 0:
+            return None
+        return self.task.generated // self.burstsamples
+
+    def streamoutput(self, output, prefill=2):
+        self.applyplan(self.planoutput(self.sample_rate, output.length, 
+                                       "Stream", self.retriggering()))
+        self.task.sample_rate = self.sample_rate
+        self.task.finite_samples = output.length
+        self.configuretrigger(True, retriggerable=False)
+        self.burstsamples = output.length
+        chunks = output.chunks()
+        for _, chunk in zip(range(prefill), chunks):
+            pass
+        self.task.start()
+        self.streamthread = threading.Thread(target=self.streamchunks, 
+                                             args=(chunks, output), daemon=True)
+        self.streamthread.start()
+
+    def streamchunks(self, chunks, output):
+        for chunk in chunks:
+            if self.streamstop.is_set():
+                return
+        self.writesamples(np.array(output.array))
+
+    def stopstream(self):
+        if self.streamthread is not None:
+            self.streamstop.set()
+            self.streamthread.join()
+            self.streamthread = None
+            self.streamstop.clear()
+
+    def writesamples(self, samples, timeout=10.0):
+        channels = 2 if self.multichan else 1
+        if self.rawoutput:
+            samples = self.rawsamples(samples)
+        self.lastoutput = samples[:channels,:]
+
+    def scalingcoefficients(self):
+        # A myDAQ has a +/-10 V range on 16 bits.
+        channels = 2 if self.multichan else 1
+        return [[0, 32767/10]]*channels
@@ -0,0 +1,137 @@
+""" outputpipeline.py
+This module contains the stages between the settings and the DAQ: the
+preview of the Plot Window and planning, calculating, pausing and
+writing an output. The Mainwindow and the replay of a journal (see
+replay.py) both use the Outputpipeline, so the replay times the same
+code as the window, which only updates its widgets around it. Every
+stage is timed with a Stagetimer of journal.py.
+"""
+
+
+import numpy as np
+
+from waveforms import outputlength
+from parallelgen import PARALLELSAMPLES
+
+
+__author__ = "Jaimy Plugge"
+
+
+class Outputpipeline:
+    def __init__(self, waveformmatrix, cache, generator, previewengine,
+                 daqout=False):
+        """
+        daqout is the Writer (or Writerprocess or Simwriter) and
+        can be set later, when the channels are chosen.
+        """
+        self.waveformmatrix = waveformmatrix
+        self.cache = cache
+        self.generator = generator
+        self.previewengine = previewengine
+        self.daqout = daqout
+        # The shared memory of the output that is being streamed.
+        self.sharedoutput = None
+
+    def preview(self, settings, tstart, tstop, points, timer):
+        with timer.stage("preview"):
+            return self.previewengine.window(settings, tstart, tstop, points)
+
+    def route(self, settings):
+        """
+        Return how the output of the settings is written and the
+        amount of samples to plan for. Presets have their output
+        in the cache and are written at once, very long finite
+        outputs that are not in the cache are calculated in
+        parallel while they are streamed.
+        """
+        length = outputlength(settings)
+        if length is None:
+            return "Continuous", self.waveformmatrix.shape[1]
+        if (length > PARALLELSAMPLES and
+                not self.cache.contains(settings, self.waveformmatrix)):
+            return "Stream", length
+        return "Finite", length
+
+    def plan(self, settings, timer):
+        """
+        Check the output against the device, before anything is
+        changed. The plan also gets the "route" of the output.
+        """
+        route, length = self.route(settings)
+        with timer.stage("plan"):
+            plan = self.daqout.planoutput(
+                int(float(settings["samplerate"])), length, route,
+                settings["trigger"] == "Retriggerable",
+                settings["outputdata"] == "Raw int16")
+        plan["route"] = route
+        return plan
+
+    def send(self, settings, timer, readback=None):
+        """
+        Plan, calculate and write the output of the settings and
+        return the plan. When the plan has problems nothing is
+        changed, otherwise the plan gets the "mode" and "length"
+        of the output that was sent. A Reader given as readback
+        is started right before the output, because it waits for
+        the start trigger of the output.
+        """
+        plan = self.plan(settings, timer)
+        if len(plan["problems"]) > 0:
+            return plan
+        samplerate = int(float(settings["samplerate"]))
+        rawoutput = settings["outputdata"] == "Raw int16"
+        dtype = np.float32 if rawoutput else float
+        sharedoutput = None
+        with timer.stage("generate"):
+            if plan["route"] == "Stream":
+                sharedoutput = self.generator.generate(settings, dtype)
+                outputmode = sharedoutput.mode
+                length = sharedoutput.length
+            else:
+                outputmode, outputsignal = self.cache.output(
+                    settings, self.waveformmatrix, dtype=dtype)
+                length = outputsignal.shape[1]
+        with timer.stage("pause"):
+            self.daqout.pausefunc()
+            if self.sharedoutput is not None:
+                self.sharedoutput.close()
+        self.sharedoutput = sharedoutput
+        self.daqout.sample_rate = samplerate
+        self.daqout.rawoutput = rawoutput
+        if settings["trigger"] == "Software":
+            self.daqout.triggersource = ""
+        else:
+            self.daqout.triggersource = settings["triggersource"]
+        self.daqout.triggeredge = settings["triggeredge"]
+        self.daqout.retriggerable = settings["trigger"] == "Retriggerable"
+        if readback is not None:
+            with timer.stage("readback"):
+                readback.start(samplerate, self.daqout.chan_name1)
+        with timer.stage("write"):
+            if sharedoutput is not None:
+                self.daqout.streamoutput(sharedoutput)
+            elif outputmode == "Finite":
+                self.daqout.singleoutput(outputsignal)
+            else:
+                self.daqout.outputcontinuously(outputsignal)
+        plan["mode"] = outputmode
+        plan["length"] = length
+        return plan
+
+    def stop(self, timer):
+        """
+        Stop the output and set both channels to 0 V.
+        """
+        with timer.stage("pause"):
+            self.daqout.pausefunc()
+            if self.sharedoutput is not None:
+                self.sharedoutput.close()
+                self.sharedoutput = None
+        with timer.stage("write"):
+            self.daqout.outputcontinuously(np.zeros((2, 10), dtype=float),
+                                           trigger=False)
+
+    def close(self):
+        if self.sharedoutput is not None:
+            self.sharedoutput.close()
+            self.sharedoutput = None
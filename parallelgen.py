@@ -0,0 +1,150 @@
+""" parallelgen.py
+This module calculates very long finite outputs on all cores of the
+computer. The time axis is split in chunks and every chunk is filled
+by a worker of a process (or thread) pool, directly in a shared memory
+buffer, so the samples never have to be copied between processes.
+Every chunk is calculated from its own first sample index with
+waveforms.outputsamples, so the chunks do not depend on each other.
+The chunks are done roughly in order, which makes it possible for the
+Writer to start sending the first chunks while the last ones are still
+being calculated.
+"""
+
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from waveforms import outputlength, outputmode, outputsamples
+
+
+__author__ = "Jaimy Plugge"
+
+
+# Finite outputs with more samples than this are calculated in
+# parallel by the Mainwindow.
+PARALLELSAMPLES = 2**23
+
+# Lookup table of the worker processes, see initworker.
+workermatrix = None
+
+
+def initworker(waveformmatrix):
+    global workermatrix
+    workermatrix = waveformmatrix
+
+
+def fillchunk(shmname, shape, dtype, settings, start, stop,
+              waveformmatrix=None):
+    """
+    Calculate samples start up to stop and write them in the
+    shared memory buffer. This runs in a worker.
+    """
+    if waveformmatrix is None:
+        waveformmatrix = workermatrix
+    shm = shared_memory.SharedMemory(name=shmname)
+    try:
+        output = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        output[:,start:stop] = outputsamples(settings, waveformmatrix,
+                                             np.arange(start, stop))
+        del output
+    finally:
+        shm.close()
+    return start, stop
+
+
+class Sharedoutput:
+    """
+    The output buffer in shared memory together with the
+    futures of its chunks. Call close when the output is not
+    needed anymore.
+    """
+    def __init__(self, mode, shape, dtype, chunksize):
+        self.mode = mode
+        self.chunksize = chunksize
+        self.length = shape[1]
+        self.shm = shared_memory.SharedMemory(
+            create=True, size=max(1, int(np.prod(shape))*np.dtype(dtype).itemsize))
+        self.array = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf)
+        self.futures = []
+
+    def chunks(self):
+        """
+        Yield the chunks in order, every chunk as soon as it is
+        calculated.
+        """
+        for future in self.futures:
+            start, stop = future.result()
+            yield self.array[:,start:stop]
+
+    def wait(self):
+        for future in self.futures:
+            future.result()
+        return self.array
+
+    def close(self):
+        for future in self.futures:
+            future.cancel()
+        for future in self.futures:
+            if not future.cancelled():
+                future.exception()
+        self.array = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+class Parallelgenerator:
+    def __init__(self, waveformmatrix, workers=None, chunksize=2**20,
+                 kind="process"):
+        """
+        kind is "process" or "thread". Threads start faster,
+        processes are faster for the waveforms that do not
+        release the GIL.
+        """
+        self.waveformmatrix = waveformmatrix
+        self.workers = workers or os.cpu_count()
+        self.chunksize = chunksize
+        self.kind = kind
+        self.pool = None
+
+    def startpool(self):
+        if self.pool is None:
+            if self.kind == "process":
+                # Spawn, because forking a process with tkinter and
+                # other threads in it is not safe.
+                self.pool = ProcessPoolExecutor(
+                    self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=initworker, initargs=(self.waveformmatrix,))
+            else:
+                self.pool = ThreadPoolExecutor(self.workers)
+
+    def generate(self, settings, dtype=float):
+        """
+        Start calculating the finite output of the settings and
+        return the Sharedoutput right away.
+        """
+        length = outputlength(settings)
+        if length is None:
+            raise ValueError("Only finite outputs can be made in parallel")
+        self.startpool()
+        output = Sharedoutput(outputmode(settings), (2, length), dtype,
+                              self.chunksize)
+        # Threads share the lookup table, processes got it once
+        # when they were started.
+        waveformmatrix = self.waveformmatrix if self.kind == "thread" else None
+        for start in range(0, length, self.chunksize):
+            stop = min(start+self.chunksize, length)
+            output.futures.append(self.pool.submit(
+                fillchunk, output.shm.name, output.array.shape,
+                output.array.dtype.str, dict(settings), start, stop,
+                waveformmatrix))
+        return output
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
@@ -0,0 +1,172 @@
+""" presets.py
+This module saves the settings of the AWG under a name, so they can be
+recalled later instead of typing all the values again. Next to the
+settings, the compiled output of a preset is kept in a cache on disk.
+The cache is content addressed: the name of every .npy file is a hash
+of the settings that made it, so the same settings always give the
+same file and a long DC ramp does not have to be calculated again.
+Cached files are memory mapped when they are loaded and the oldest
+files are removed once the cache gets bigger than its size limit.
+"""
+
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from waveforms import DEFAULTSETTINGS, OUTPUTOPTIONS, buildoutput, outputmode
+
+
+__author__ = "Jaimy Plugge"
+
+
+PRESETDIR = os.path.join(os.path.expanduser("~"), ".nidaq_awg")
+
+# Change this when the output of waveforms.py changes, so old cached
+# buffers are not used anymore.
+CACHEVERSION = 1
+
+
+def settingshash(settings, tablelength):
+    """
+    Return the hash that is used as the file name in the cache.
+    The length of the lookup table is part of the hash because
+    the continuous output depends on it. The OUTPUTOPTIONS are
+    left out, they do not change the samples.
+    """
+    key = {}
+    for name in DEFAULTSETTINGS:
+        if name in OUTPUTOPTIONS:
+            continue
+        value = settings[name]
+        # 10000 and 10000.0 should give the same hash.
+        if isinstance(value, (int, float)):
+            value = float(value)
+        key[name] = value
+    key["tablelength"] = tablelength
+    key["version"] = CACHEVERSION
+    text = json.dumps(key, sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class Waveformcache:
+    """
+    Directory with one .npy file per compiled output. The
+    total size of the directory is kept below maxbytes by
+    removing the files that were used the longest time ago.
+    """
+    def __init__(self, directory=os.path.join(PRESETDIR, "cache"),
+                 maxbytes=2E9):
+        self.directory = directory
+        self.maxbytes = maxbytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npy")
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            outputsignal = np.load(path, mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+        # Mark the file as recently used for the eviction.
+        os.utime(path)
+        return outputsignal
+
+    def put(self, key, outputsignal):
+        path = self.path(key)
+        temppath = path + ".tmp"
+        with open(temppath, "wb") as file:
+            np.save(file, np.ascontiguousarray(outputsignal))
+        os.replace(temppath, path)
+        self.evict()
+
+    def evict(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npy"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.maxbytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def contains(self, settings, waveformmatrix):
+        key = settingshash(settings, waveformmatrix.shape[1])
+        return os.path.exists(self.path(key))
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npy"):
+                os.remove(entry.path)
+
+    def output(self, settings, waveformmatrix, dtype=float):
+        """
+        Return the output mode and output array for the given
+        settings, from the cache if it is there. The dtype is 
+        only used when the output has to be calculated.
+        """
+        key = settingshash(settings, waveformmatrix.shape[1])
+        outputsignal = self.get(key)
+        if outputsignal is None:
+            return buildoutput(settings, waveformmatrix, dtype)
+        return outputmode(settings), outputsignal
+
+    def store(self, settings, waveformmatrix):
+        """
+        Build the output for the given settings and put it in
+        the cache.
+        """
+        mode, outputsignal = buildoutput(settings, waveformmatrix)
+        self.put(settingshash(settings, waveformmatrix.shape[1]), outputsignal)
+        return mode, outputsignal
+
+
+class Presetstore:
+    """
+    Keeps the named presets in a single json file. Every
+    preset is the settings dictionary of Mainwindow.
+    """
+    def __init__(self, path=os.path.join(PRESETDIR, "presets.json"),
+                 cache=None):
+        self.path = path
+        self.cache = cache
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        try:
+            with open(self.path) as file:
+                self.presets = json.load(file)
+        except (OSError, ValueError):
+            self.presets = {}
+
+    def names(self):
+        return sorted(self.presets)
+
+    def save(self, name, settings, waveformmatrix=None):
+        self.presets[name] = {key: settings[key] for key in DEFAULTSETTINGS}
+        self.write()
+        if self.cache is not None and waveformmatrix is not None:
+            self.cache.store(settings, waveformmatrix)
+
+    def load(self, name):
+        settings = dict(DEFAULTSETTINGS)
+        settings.update(self.presets[name])
+        return settings
+
+    def delete(self, name):
+        del self.presets[name]
+        self.write()
+
+    def write(self):
+        temppath = self.path + ".tmp"
+        with open(temppath, "w") as file:
+            json.dump(self.presets, file, indent=4)
+        os.replace(temppath, self.path)
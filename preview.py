@@ -0,0 +1,101 @@
+""" preview.py
+This module calculates the samples for the Plot Window. Instead of
+making the whole output and only showing a small part of it, only the
+samples inside the visible time window are calculated, at about the
+resolution of the screen. When the view is zoomed in far enough every
+sample is shown. The samples are calculated in tiles of a fixed amount
+of points and the last used tiles are kept, so panning back and forth
+does not calculate the same samples again. Segment profiles are shown
+as the lowest and highest sample per pixel instead, so short bursts
+are not lost when the whole profile is shown.
+"""
+
+
+from collections import OrderedDict
+
+import numpy as np
+
+from waveforms import (OUTPUTOPTIONS, outputlength, outputsamples, isprofile,
+                       profileoutput)
+
+
+__author__ = "Jaimy Plugge"
+
+
+class Previewengine:
+    def __init__(self, waveformmatrix, tilepoints=1024, maxtiles=512):
+        self.waveformmatrix = waveformmatrix
+        self.tilepoints = tilepoints
+        self.maxtiles = maxtiles
+        self.tiles = OrderedDict()
+
+    def window(self, settings, tstart, tstop, points):
+        """
+        Return the times and the samples of both channels
+        between tstart and tstop, with at most about 2*points
+        samples. The step between the shown samples is a power
+        of two, so tiles can be reused while zooming.
+        """
+        samplerate = float(settings["samplerate"])
+        first = max(0, int(np.floor(tstart*samplerate)))
+        last = max(first+1, int(np.ceil(tstop*samplerate))+1)
+        length = outputlength(settings)
+        if length is not None:
+            last = min(last, length)
+            first = min(first, last-1)
+        span = last-first
+        if isprofile(settings):
+            return self.envelope(settings, first, last, points)
+        level = max(0, int(np.ceil(np.log2(max(span/points, 1)))))
+        step = 2**level
+        tilesamples = step*self.tilepoints
+
+        # The profile is a dict, which can not be in the key, and
+        # only matters for the Profile output, which returns above.
+        key = tuple(sorted((name, value) for name, value in settings.items()
+                           if name != "profile" and name not in OUTPUTOPTIONS))
+        indices = []
+        samples = []
+        for tile in range(first//tilesamples, (last-1)//tilesamples+1):
+            index, y = self.tile(key, settings, level, tile)
+            indices.append(index)
+            samples.append(y)
+        index = np.concatenate(indices)
+        y = np.hstack(samples)
+        inside = (index >= first) & (index < last)
+        return index[inside]/samplerate, y[:,inside]
+
+    def envelope(self, settings, first, last, points):
+        """
+        Return the decimated envelope of a segment profile:
+        every time twice, with the lowest and the highest
+        sample in the bucket that starts there.
+        """
+        profile = profileoutput(settings)
+        samplerate = profile.samplerate
+        if last-first <= 2*points:
+            index = np.arange(first, last)
+            return index/samplerate, profile.samples(index)
+        bucketstart, low, high = profile.envelope(first, last, points)
+        t = np.repeat(bucketstart/samplerate, 2)
+        y = np.stack((low, high), axis=2).reshape(2, -1)
+        return t, y
+
+    def tile(self, key, settings, level, tile):
+        tilekey = (key, level, tile)
+        if tilekey in self.tiles:
+            self.tiles.move_to_end(tilekey)
+            return self.tiles[tilekey]
+        step = 2**level
+        index = (tile*self.tilepoints + np.arange(self.tilepoints))*step
+        length = outputlength(settings)
+        if length is not None:
+            index = index[index < length]
+        result = (index, outputsamples(settings, self.waveformmatrix, index))
+        self.tiles[tilekey] = result
+        if len(self.tiles) > self.maxtiles:
+            self.tiles.popitem(last=False)
+        return result
+
+    def clear(self):
+        self.tiles.clear()
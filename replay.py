@@ -0,0 +1,238 @@
+""" replay.py
+This script runs a session journal (see journal.py) again without a
+window, on the simulated DAQ. Every plot, zoom, send and stop of the
+journal goes through the same Outputpipeline as in nidaq_awg.py: the
+preview of the Plot Window, planning, calculating and writing the output
+with the Simwriter. The timings of every stage are compared with the timings in
+the journal, so a slow Send can be reproduced and two versions of the
+code can be compared. The replay starts with an empty waveform cache,
+so presets that were cached during the session are calculated again.
+
+    python replay.py session.jsonl
+    python replay.py session.jsonl --output replayed.jsonl
+    python replay.py --compare old.jsonl new.jsonl
+"""
+
+
+import argparse
+import tempfile
+
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from nidaqwriter import Simwriter
+from waveforms import DEFAULTSETTINGS, lookuptable
+from presets import Waveformcache
+from preview import Previewengine
+from parallelgen import Parallelgenerator
+from outputpipeline import Outputpipeline
+from journal import Journal, Stagetimer, readjournal
+
+
+__author__ = "Jaimy Plugge"
+
+
+# The events that have timings and are replayed.
+TIMED = ["plot", "zoom", "send", "stop"]
+
+
+class Replaysession:
+    """
+    The parts of the Mainwindow that are timed, without the
+    window. The events are replayed back to back, the time
+    between them in the session is not waited.
+    """
+    def __init__(self, journal=None):
+        self.time_axis, self.waveformmatrix = lookuptable(100000)
+        self.cachedirectory = tempfile.TemporaryDirectory()
+        self.cache = Waveformcache(self.cachedirectory.name)
+        self.generator = Parallelgenerator(self.waveformmatrix)
+        self.daqout = Simwriter("sim/ao0", "sim/ao1", 10000)
+        self.pipeline = Outputpipeline(self.waveformmatrix, self.cache,
+                                       self.generator,
+                                       Previewengine(self.waveformmatrix),
+                                       self.daqout)
+        self.fig = Figure()
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.axs = self.fig.add_subplot()
+        self.previewsettings = dict(DEFAULTSETTINGS)
+        self.previewartists = []
+        self.journal = journal
+
+    def run(self, event):
+        """
+        Replay one event and return the timings of its stages,
+        or None for events that are not timed.
+        """
+        if "settings" in event:
+            # Journals of older versions miss the newer settings and
+            # had the trigger and raw output next to the settings.
+            settings = dict(DEFAULTSETTINGS, **event["settings"])
+            for name in ("trigger", "triggersource", "triggeredge"):
+                if name in event and name not in event["settings"]:
+                    settings[name] = event[name]
+            if "rawoutput" in event and "outputdata" not in event["settings"]:
+                settings["outputdata"] = ("Raw int16" if event["rawoutput"]
+                                          else "Scaled float64")
+            event = dict(event, settings=settings)
+        if event["event"] == "plot":
+            timings = self.plotupdate(event["settings"], event["xlim"],
+                                      event["points"])
+        elif event["event"] == "zoom":
+            timings = self.updatepreview(event["xlim"], event["points"])
+        elif event["event"] == "send":
+            timings = self.sendsignal(event["settings"])
+        elif event["event"] == "stop":
+            timings = self.stopoutput()
+        else:
+            return None
+        if self.journal is not None:
+            fields = {name: value for name, value in event.items()
+                      if name not in ("t", "event", "timings", "changes",
+                                      "settings")}
+            if "settings" in event:
+                self.journal.recordsettings(event["settings"], event["event"],
+                                            timings, **fields)
+            else:
+                self.journal.record(event["event"], timings, **fields)
+        return timings
+
+    def plotupdate(self, settings, xlim, points):
+        self.axs.clear()
+        self.previewsettings = settings
+        timer = Stagetimer()
+        t, y = self.pipeline.preview(settings, *xlim, points, timer)
+        self.previewartists = [self.axs.scatter(t, y[0], s=0.3),
+                               self.axs.scatter(t, y[1], s=0.3)]
+        self.axs.set_xlim(*xlim)
+        self.axs.set_xlabel('Time [s]')
+        self.axs.set_ylabel('Amplitude [V]')
+        with timer.stage("draw"):
+            self.canvas.draw()
+        return timer.timings
+
+    def updatepreview(self, xlim, points):
+        timer = Stagetimer()
+        t, y = self.pipeline.preview(self.previewsettings, *xlim, points,
+                                     timer)
+        for artist, row in zip(self.previewartists, y):
+            artist.set_offsets(np.column_stack((t, row)))
+        return timer.timings
+
+    def sendsignal(self, settings):
+        timer = Stagetimer()
+        self.pipeline.send(settings, timer)
+        return timer.timings
+
+    def stopoutput(self):
+        timer = Stagetimer()
+        self.pipeline.stop(timer)
+        return timer.timings
+
+    def close(self):
+        self.daqout.stopfunc()
+        self.pipeline.close()
+        self.generator.shutdown()
+        self.cachedirectory.cleanup()
+
+
+def replay(events, repeat=1, journal=None):
+    """
+    Replay the events <repeat> times and return the shortest
+    timings of every timed event, in order. Only the first
+    replay is written to the journal.
+    """
+    best = None
+    for run in range(repeat):
+        session = Replaysession(journal if run == 0 else None)
+        try:
+            timings = [session.run(event) for event in events
+                       if event["event"] in TIMED]
+        finally:
+            session.close()
+        if best is None:
+            best = timings
+        else:
+            best = [{stage: min(seconds, old.get(stage, np.inf))
+                     for stage, seconds in new.items()}
+                    for new, old in zip(timings, best)]
+    return best
+
+
+def report(names, before, after, labels):
+    """
+    Print the timings of every stage before and after and the
+    totals per kind of event and stage.
+    """
+    print(f"{'#':>4} {'event':<6}{'stage':<10}{labels[0]+' [ms]':>14}"
+          f"{labels[1]+' [ms]':>14}{'change':>9}")
+    totals = {}
+    for index, (name, old, new) in enumerate(zip(names, before, after)):
+        for stage in sorted(set(old) | set(new)):
+            oldtime = old.get(stage, np.nan)
+            newtime = new.get(stage, np.nan)
+            change = (newtime/oldtime - 1)*100 if oldtime > 0 else np.nan
+            print(f"{index:>4} {name:<6}{stage:<10}{oldtime*1E3:>14.3f}"
+                  f"{newtime*1E3:>14.3f}{change:>8.0f}%")
+            total = totals.setdefault((name, stage), [0, 0])
+            total[0] += oldtime
+            total[1] += newtime
+    print(f"\n{'event':<6}{'stage':<10}{labels[0]+' [ms]':>14}"
+          f"{labels[1]+' [ms]':>14}{'change':>9}")
+    for (name, stage), (oldtime, newtime) in totals.items():
+        change = (newtime/oldtime - 1)*100 if oldtime > 0 else np.nan
+        print(f"{name:<6}{stage:<10}{oldtime*1E3:>14.3f}"
+              f"{newtime*1E3:>14.3f}{change:>8.0f}%")
+
+
+def timedevents(events):
+    return [event for event in events
+            if event["event"] in TIMED and "timings" in event]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a session journal "
+                                                 "on the simulated DAQ.")
+    parser.add_argument("journal", nargs="?")
+    parser.add_argument("--output", default=None,
+                        help="write the replay to this journal")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare the timings of two journals")
+    args = parser.parse_args()
+
+    if args.compare:
+        old, new = (timedevents(readjournal(path)) for path in args.compare)
+        if len(old) != len(new):
+            print(f"The journals have {len(old)} and {len(new)} timed events, "
+                  f"only the first {min(len(old), len(new))} are compared")
+        versions = [readjournal(path)[0].get("version", "?")
+                    for path in args.compare]
+        print(f"Comparing version {versions[0]} with {versions[1]}\n")
+        report([event["event"] for event in old],
+               [event["timings"] for event in old],
+               [event["timings"] for event in new], ["old", "new"])
+        return
+    if args.journal is None:
+        parser.error("give a journal or --compare")
+
+    events = readjournal(args.journal)
+    recorded = timedevents(events)
+    journal = Journal(args.output) if args.output else None
+    try:
+        replayed = replay(recorded, args.repeat, journal)
+    finally:
+        if journal is not None:
+            journal.close()
+    print(f"Replayed {len(recorded)} events of version "
+          f"{events[0].get('version', '?')}\n")
+    report([event["event"] for event in recorded],
+           [event["timings"] for event in recorded], replayed,
+           ["session", "replay"])
+    done = sum(event["event"] == "done" for event in events)
+    print(f"\nThe session had {done} done event(s), these are not replayed.")
+
+
+if __name__ == "__main__":
+    main()
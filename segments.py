@@ -0,0 +1,265 @@
+""" segments.py
+This module makes outputs out of a list of segments per channel, the
+general version of the ramped DC output of constructdcramp. A profile
+is a dictionary (usually loaded from a .json file) like:
+
+    {"channel1": [{"type": "hold", "duration": 0.5, "level": 0},
+                  {"type": "ramp", "duration": 1, "to": 5},
+                  {"type": "sine", "duration": 0.2, "amp": 0.5,
+                   "freq": 100},
+                  {"type": "settle", "duration": 1, "to": 0,
+                   "tau": 0.1}],
+     "channel2": [...]}
+
+Every segment starts at the level where the previous one ended (0 V
+for the first one):
+
+    hold    stays at "level" (default: the current level)
+    ramp    goes in a straight line to "to"
+    sine    a sine burst of "amp" and "freq" (and "phase" in radians)
+            around the current level
+    settle  goes exponentially to "to" with time constant "tau"
+
+The samples of a segment are calculated in one go with numpy, only
+where they are needed: for the whole output, a chunk of it or the
+samples of the preview. The channel that ends first stays at 0 V.
+"""
+
+
+import json
+from functools import lru_cache
+
+import numpy as np
+
+
+__author__ = "Jaimy Plugge"
+
+
+def holdsamples(k, samplerate, level, segment):
+    return np.full(len(k), float(segment.get("level", level)))
+
+
+def rampsamples(k, samplerate, level, segment):
+    count = max(1, round(float(segment["duration"])*samplerate))
+    return level + (float(segment["to"])-level)*(k/count)
+
+
+def sinesamples(k, samplerate, level, segment):
+    return level + float(segment["amp"])*np.sin(
+        2*np.pi*float(segment["freq"])*(k/samplerate)
+        + float(segment.get("phase", 0)))
+
+
+def settlesamples(k, samplerate, level, segment):
+    to = float(segment["to"])
+    return to + (level-to)*np.exp(-(k/samplerate)/float(segment["tau"]))
+
+
+SEGMENTTYPES = {"hold": holdsamples,
+                "ramp": rampsamples,
+                "sine": sinesamples,
+                "settle": settlesamples}
+
+# The values every type of segment needs next to "duration".
+REQUIRED = {"hold": [],
+            "ramp": ["to"],
+            "sine": ["amp", "freq"],
+            "settle": ["to", "tau"]}
+
+# The values that have to be numbers when they are given.
+NUMBERS = ["duration", "level", "to", "amp", "freq", "phase", "tau"]
+
+
+def checksegment(segment, name):
+    """
+    Raise a ValueError when a segment is not a dictionary with
+    a known type, its required values and finite numbers.
+    """
+    if not isinstance(segment, dict):
+        raise ValueError(f"Every segment in {name} should be a dictionary")
+    if segment.get("type") not in SEGMENTTYPES:
+        raise ValueError(f"Unknown segment type {segment.get('type')!r} in "
+                         f"{name}")
+    kind = segment["type"]
+    missing = [key for key in ["duration"]+REQUIRED[kind]
+               if key not in segment]
+    if missing:
+        raise ValueError(f"The {kind} segment in {name} has no "
+                         f"{', '.join(missing)}")
+    for key in NUMBERS:
+        if key not in segment:
+            continue
+        try:
+            value = float(segment[key])
+        except (TypeError, ValueError):
+            value = np.nan
+        if not np.isfinite(value):
+            raise ValueError(f"The {key} of the {kind} segment in {name} "
+                             f"should be a finite number")
+    if kind == "settle" and float(segment["tau"]) <= 0:
+        raise ValueError(f"The tau of the settle segment in {name} should be "
+                         f"more than 0")
+
+
+def endlevel(samplerate, level, segment, count):
+    """
+    Return the level the next segment starts at.
+    """
+    if segment["type"] == "hold":
+        return float(segment.get("level", level))
+    elif segment["type"] == "ramp":
+        return float(segment["to"])
+    elif segment["type"] == "settle":
+        return float(settlesamples(np.array([count]), samplerate, level,
+                                   segment)[0])
+    return level
+
+
+class Compiledprofile:
+    """
+    The segments of both channels with their first sample and
+    starting level, so any sample of the output can be found
+    without making the rest.
+    """
+    def __init__(self, profile, samplerate):
+        if not isinstance(profile, dict):
+            raise ValueError("A profile should be a dictionary with "
+                             "channel1 and channel2")
+        self.samplerate = float(samplerate)
+        self.channels = []
+        for name in ("channel1", "channel2"):
+            table = []
+            start = 0
+            level = 0.
+            segments = profile.get(name, []) or []
+            if not isinstance(segments, list):
+                raise ValueError(f"{name} should be a list of segments")
+            for segment in segments:
+                checksegment(segment, name)
+                count = round(float(segment["duration"])*self.samplerate)
+                if count <= 0:
+                    continue
+                table.append((start, count, level, segment))
+                level = endlevel(self.samplerate, level, segment, count)
+                start += count
+            self.channels.append(table)
+        self.length = max([1] + [channel[-1][0]+channel[-1][1]
+                                 for channel in self.channels if channel])
+        # The channel that ends first stays at 0 V.
+        for channel in self.channels:
+            end = channel[-1][0]+channel[-1][1] if channel else 0
+            if end < self.length:
+                channel.append((end, self.length-end, 0.,
+                                {"type": "hold", "level": 0}))
+
+    def samples(self, index):
+        """
+        Return the samples of both channels at the given sample
+        indices, which have to be in increasing order. Indices
+        after the end give 0 V.
+        """
+        index = np.asarray(index, dtype=np.int64)
+        output = np.zeros((2, len(index)))
+        for row, channel in zip(output, self.channels):
+            for start, count, level, segment in channel:
+                first, last = np.searchsorted(index, [start, start+count])
+                if first == last:
+                    continue
+                k = (index[first:last] - start).astype(float)
+                row[first:last] = SEGMENTTYPES[segment["type"]](
+                    k, self.samplerate, level, segment)
+        return output
+
+    def chunks(self, chunksize=2**20, dtype=float):
+        """
+        Yield the first sample index and the samples of every
+        chunk of the output, for streaming it to the DAQ.
+        """
+        for start in range(0, self.length, chunksize):
+            stop = min(start+chunksize, self.length)
+            yield start, self.samples(np.arange(start, stop)).astype(dtype)
+
+    def compile(self, dtype=float, chunksize=2**20):
+        """
+        Return the whole two channel output. The array is made
+        at its exact length once and filled chunk by chunk, so
+        the temporary arrays stay small.
+        """
+        output = np.empty((2, self.length), dtype=dtype)
+        for start, chunk in self.chunks(chunksize, dtype):
+            output[:,start:start+chunk.shape[1]] = chunk
+        return output
+
+    def envelope(self, first, last, buckets):
+        """
+        Return the first sample of every bucket and the lowest
+        and highest sample of both channels in the bucket, for
+        samples first up to last. Holds, ramps and settles only
+        go one way, so their extremes are at the edges of the
+        bucket; a sine also reaches its top or bottom when the
+        bucket contains one.
+        """
+        size = max(1, -(-(last-first)//buckets))
+        bucketstart = np.arange(first, last, size)
+        bucketstop = np.minimum(bucketstart+size, last)
+        low = np.full((2, len(bucketstart)), np.inf)
+        high = np.full((2, len(bucketstart)), -np.inf)
+        for lowrow, highrow, channel in zip(low, high, self.channels):
+            for start, count, level, segment in channel:
+                stop = start+count
+                if stop <= first or start >= last:
+                    continue
+                b0 = (max(start, first)-first)//size
+                b1 = (min(stop, last)-1-first)//size + 1
+                a = np.maximum(bucketstart[b0:b1], start) - start
+                b = np.minimum(bucketstop[b0:b1], stop) - 1 - start
+                func = SEGMENTTYPES[segment["type"]]
+                edges = np.vstack((func(a.astype(float), self.samplerate,
+                                        level, segment),
+                                   func(b.astype(float), self.samplerate,
+                                        level, segment)))
+                segmentlow = edges.min(axis=0)
+                segmenthigh = edges.max(axis=0)
+                if segment["type"] == "sine":
+                    amp = float(segment["amp"])
+                    freq = float(segment["freq"])
+                    phase = float(segment.get("phase", 0))/(2*np.pi)
+                    cyclea = freq*a/self.samplerate + phase
+                    cycleb = freq*b/self.samplerate + phase
+                    for where, value in ((0.25, level+amp),
+                                         (0.75, level-amp)):
+                        inside = np.ceil(cyclea-where) <= cycleb-where
+                        segmentlow = np.where(inside, np.minimum(segmentlow,
+                                                                 value),
+                                              segmentlow)
+                        segmenthigh = np.where(inside,
+                                               np.maximum(segmenthigh, value),
+                                               segmenthigh)
+                lowrow[b0:b1] = np.minimum(lowrow[b0:b1], segmentlow)
+                highrow[b0:b1] = np.maximum(highrow[b0:b1], segmenthigh)
+        return bucketstart, low, high
+
+
+@lru_cache(maxsize=16)
+def cachedprofile(text, samplerate):
+    return Compiledprofile(json.loads(text), samplerate)
+
+
+def compiledprofile(profile, samplerate):
+    """
+    Return the Compiledprofile of a profile. The last used
+    profiles are kept, so the preview and the chunks of a
+    stream do not compile the same profile again.
+    """
+    return cachedprofile(json.dumps(profile or {}, sort_keys=True),
+                         float(samplerate))
+
+
+def loadprofile(path):
+    """
+    Read a profile from a .json file and check its segments.
+    """
+    with open(path) as file:
+        profile = json.load(file)
+    Compiledprofile(profile, 1000)
+    return profile
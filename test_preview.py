@@ -0,0 +1,49 @@
+""" test_preview.py
+Tests of the Previewengine, run with "python -m pytest".
+"""
+
+
+import numpy as np
+
+from waveforms import DEFAULTSETTINGS, lookuptable
+from preview import Previewengine
+
+
+__author__ = "Jaimy Plugge"
+
+
+PROFILE = {"channel1": [{"type": "ramp", "duration": 0.1, "to": 1}],
+           "channel2": [{"type": "hold", "duration": 0.1, "level": 2}]}
+
+
+def makeengine():
+    time_axis, waveformmatrix = lookuptable(1000)
+    return Previewengine(waveformmatrix)
+
+
+def test_profile_loaded_continuous():
+    # A loaded profile stays in the settings when another output
+    # is chosen, the preview should ignore it.
+    engine = makeengine()
+    settings = dict(DEFAULTSETTINGS, profile=PROFILE, output="Continuous",
+                    waveform1="Sine")
+    t, y = engine.window(settings, 0, 0.1, 500)
+    assert y.shape == (2, len(t))
+    nowprofile = dict(settings, profile=None)
+    assert np.array_equal(engine.window(nowprofile, 0, 0.1, 500)[1], y)
+
+
+def test_profile_loaded_finite():
+    engine = makeengine()
+    settings = dict(DEFAULTSETTINGS, profile=PROFILE, output="Finite",
+                    waveform1="Sine", amount=3)
+    t, y = engine.window(settings, 0, 1, 500)
+    assert t[-1] < 3/float(settings["freq1"])
+
+
+def test_profile_output():
+    engine = makeengine()
+    settings = dict(DEFAULTSETTINGS, profile=PROFILE, output="Profile")
+    t, y = engine.window(settings, 0, 0.1, 2000)
+    assert np.isclose(y[0,-1], 1, atol=1E-3)
+    assert np.allclose(y[1], 2)
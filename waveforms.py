@@ -0,0 +1,349 @@
+""" waveforms.py
+This module contains the functions that turn the settings of the AWG
+into the sample arrays that are sent to the output DAQ. They used to
+live inside the Mainwindow class, but are now kept separate so that
+they can also be used without the tkinter window, for example by the
+control server in awgserver.py.
+"""
+
+
+import numpy as np
+from scipy import signal
+
+from segments import compiledprofile
+
+
+__author__ = "Jaimy Plugge"
+
+
+WAVEFORMDICT = {"Constant": 0,
+                "Sine": 1,
+                "Block": 2,
+                "Triangle": 3,
+                "Saw": 4}
+
+DEFAULTSETTINGS = {"samplerate": 10000,
+                   "output": "Continuous",
+                   "amount": 1,
+                   "waveform1": "Constant",
+                   "amp1": 1,
+                   "freq1": 1,
+                   "offs1": 0,
+                   "waveform2": "Constant",
+                   "amp2": 1,
+                   "freq2": 1,
+                   "offs2": 0,
+                   "delay": 0,
+                   "ramptime": 1,
+                   "dctime1": 0,
+                   "dctime2": 0,
+                   "profile": None,
+                   "outputdata": "Scaled float64",
+                   "trigger": "Software",
+                   "triggersource": "",
+                   "triggeredge": "Rising"}
+
+# Settings of the window that change how the output is sent, but not
+# its samples.
+OUTPUTOPTIONS = ["outputdata", "trigger", "triggersource", "triggeredge"]
+
+
+def constructdcramp(samplerate, ramptime, dctime, amplitude, offset, 
+                    dtype=float):
+    """
+    This function is implemented in this program because 
+    it is a certain thing that I needed for one of my 
+    experiments. It takes the amplitude and sends it for
+    <dctime> seconds. Before this constant voltage is set, 
+    the voltage will be ramped up via a sine function and 
+    also ramped down afterwards. The offset is for how many
+    seconds zero voltage should be send before the ramping.
+    """
+    time_axis = np.arange(0, offset+dctime+(2*ramptime), 1/samplerate)
+    arb = dcramp(samplerate, ramptime, dctime, amplitude, offset, dtype)
+    return time_axis, arb
+
+
+def dcramp(samplerate, ramptime, dctime, amplitude, offset, dtype=float):
+    """
+    The samples of constructdcramp without the time axis, 
+    which is only needed for the plot.
+    """
+    #ramp = .5*(1+np.sin(np.arange(-.5*np.pi, .5*np.pi, np.pi
+    #                                                   / (ramptime*samplerate))))
+    ramp = (amplitude/(ramptime)*np.arange(0,ramptime,1/(samplerate))).astype(dtype)
+    arb = np.hstack((np.zeros(int(offset*samplerate), dtype=dtype),
+                     ramp,
+                     np.full(int(dctime*samplerate), amplitude, dtype=dtype),
+                     np.flip(ramp)))
+    return arb
+
+
+def returnfinite(x, waveformtype, freq):
+    """
+    I use this method to return exactly one full pulse
+    of a certain waveform type to use for the send finite
+    pulses function. This proved to be easier to use than
+    the waveforms that are already made in the Mainwindow
+    class.
+    """
+    if waveformtype == "Sine":
+        y = np.sin(2*np.pi*freq*x)
+    elif waveformtype == "Block":
+        y = signal.square(2*np.pi*freq*x)
+    elif waveformtype == "Triangle":
+        y = signal.sawtooth(2*np.pi*freq*x, width=0.5)
+    elif waveformtype == "Saw":
+        y = signal.sawtooth(2*np.pi*freq*x)
+    else:
+        print("No waveform is chosen")
+        y = np.zeros(len(x))
+    return y
+
+
+def lookuptable(length=100000, dtype=float):
+    """
+    Make the lookup table with one period of every waveform
+    in WAVEFORMDICT. The continuous output and the preview
+    pick samples out of this table instead of calculating
+    the waveform every time.
+    """
+    time_axis = np.linspace(0,1,length)
+    waveformmatrix = np.zeros((len(WAVEFORMDICT), length), dtype=dtype)
+    waveformmatrix[1,:] = np.sin(2*np.pi*time_axis)
+    waveformmatrix[2,:] = signal.square(2*np.pi*time_axis)
+    waveformmatrix[3,:] = signal.sawtooth(2*np.pi*time_axis, width=0.5)
+    waveformmatrix[4,:] = signal.sawtooth(2*np.pi*time_axis)
+    return time_axis, waveformmatrix
+
+
+def isdcramp(settings):
+    """
+    The ramped DC output is used when finite output is chosen
+    and both channels are set to a constant voltage.
+    """
+    return (settings["output"] == "Finite" and
+            settings["waveform1"] == "Constant" and
+            settings["waveform2"] == "Constant")
+
+
+def isprofile(settings):
+    """
+    The "Profile" output sends the segment list in 
+    settings["profile"], see segments.py.
+    """
+    return settings["output"] == "Profile"
+
+
+def profileoutput(settings):
+    return compiledprofile(settings.get("profile"), settings["samplerate"])
+
+
+def dcrampoutput(settings, dtype=float):
+    """
+    Return the two channel array for the ramped DC output.
+    The shortest channel is padded with zeros.
+    """
+    samplerate = float(settings["samplerate"])
+    y1 = dcramp(samplerate, float(settings["ramptime"]),
+                float(settings["dctime1"]), float(settings["offs1"]), 0, dtype)
+    y2 = dcramp(samplerate, float(settings["ramptime"]),
+                float(settings["dctime2"]), float(settings["offs2"]),
+                float(settings["delay"]), dtype)
+    outputsignal = np.zeros((2, max(len(y1), len(y2))), dtype=dtype)
+    outputsignal[0,:len(y1)] = y1
+    outputsignal[1,:len(y2)] = y2
+    return outputsignal
+
+
+def finiteoutput(settings, dtype=float):
+    """
+    Return the two channel array for <amount> full pulses,
+    followed by a single zero so the output ends at 0 V.
+    """
+    samplerate = int(settings["samplerate"])
+    freq1 = float(settings["freq1"])
+    freq2 = float(settings["freq2"])
+    x1 = np.arange(0, 1/freq1, 1/samplerate)
+    y1 = returnfinite(x1, settings["waveform1"], freq1).astype(dtype)
+    x2 = np.arange(0, 1/freq2, 1/samplerate)
+    y2 = returnfinite(x2, settings["waveform2"], freq2).astype(dtype)
+    ynew1 = np.tile(y1, int(settings["amount"]))
+    ynew2 = np.tile(y2, int(settings["amount"]))
+
+    ynew1 = np.hstack((ynew1, np.zeros(1, dtype=dtype)))
+    ynew2 = np.roll(ynew2, int(float(samplerate)*float(settings["delay"])))
+    ynew2 = np.hstack((ynew2, np.zeros(1, dtype=dtype)))
+    return np.vstack((ynew1, ynew2))
+
+
+def continuousoutput(settings, waveformmatrix, dtype=float):
+    """
+    Return the two channel array that is repeated by the DAQ
+    in continuous mode. The samples are taken from the lookup
+    table with a step that depends on the frequency.
+    """
+    samplerate = float(settings["samplerate"])
+    length = waveformmatrix.shape[1]
+    waveformmatrix = waveformmatrix.astype(dtype, copy=False)
+
+    waveformvalue1 = WAVEFORMDICT[settings["waveform1"]]
+    skiprate1 = float(settings["freq1"])*length/samplerate
+    ind1 = ((np.arange(length)*skiprate1) % length).astype(int)
+    waveformout = (float(settings["amp1"])*waveformmatrix[waveformvalue1,ind1]
+                   + float(settings["offs1"]))
+
+    waveformvalue2 = WAVEFORMDICT[settings["waveform2"]]
+    skiprate2 = float(settings["freq2"])*length/samplerate
+    ind2 = ((np.arange(length)*skiprate2) % length).astype(int)
+    waveformout = np.vstack((waveformout,
+                             np.roll(float(settings["amp2"])
+                                     * waveformmatrix[waveformvalue2,ind2]
+                                     + float(settings["offs2"]),
+                                     int(samplerate*float(settings["delay"])))))
+    return waveformout
+
+
+def outputmode(settings):
+    """
+    Return "Finite" or "Continuous" depending on how the output
+    of the given settings has to be written to the DAQ.
+    """
+    if settings["output"] in ("Finite", "Profile"):
+        return "Finite"
+    return "Continuous"
+
+
+def buildoutput(settings, waveformmatrix, dtype=float):
+    """
+    Return the output mode ("Finite" or "Continuous") and the
+    two channel array that belongs to the given settings. Use
+    dtype=np.float32 to halve the memory of the output, for 
+    example when it is converted to raw DAC codes anyway.
+    """
+    if isprofile(settings):
+        return "Finite", profileoutput(settings).compile(dtype)
+    elif isdcramp(settings):
+        return "Finite", dcrampoutput(settings, dtype)
+    elif settings["output"] == "Finite":
+        return "Finite", finiteoutput(settings, dtype)
+    else:
+        return "Continuous", continuousoutput(settings, waveformmatrix, dtype)
+
+
+def dcramplength(samplerate, ramptime, dctime, offset):
+    """
+    Return the amount of zeros, ramp samples and dc samples
+    of the output of dcramp, without making it.
+    """
+    zeros = int(offset*samplerate)
+    ramp = len(np.arange(0,ramptime,1/(samplerate)))
+    dc = int(dctime*samplerate)
+    return zeros, ramp, dc
+
+
+def dcrampsamples(index, samplerate, ramptime, dctime, amplitude, offset):
+    """
+    Return the samples of dcramp at the given sample indices.
+    Indices after the end of the ramp down give zero. The 
+    output is linear between the corners of the ramp, so 
+    np.interp between the corners gives the samples.
+    """
+    zeros, ramp, dc = dcramplength(samplerate, ramptime, dctime, offset)
+    top = amplitude/(ramptime)*((ramp-1)*(1/samplerate))
+    corners = [(zeros, 0.), (zeros+ramp-1, top)]
+    if dc > 0:
+        corners += [(zeros+ramp, amplitude), (zeros+ramp+dc-1, amplitude)]
+    corners += [(zeros+ramp+dc, top), (zeros+2*ramp+dc-1, 0.)]
+    xp, fp = [], []
+    for x, f in corners:
+        if len(xp) == 0 or x > xp[-1]:
+            xp.append(x)
+            fp.append(f)
+    return np.interp(index, xp, fp, left=0., right=0.)
+
+
+def outputlength(settings):
+    """
+    Return the amount of samples of a finite output, or None
+    for continuous output, which repeats forever.
+    """
+    samplerate = float(settings["samplerate"])
+    if isprofile(settings):
+        return profileoutput(settings).length
+    elif isdcramp(settings):
+        lengths = []
+        for dctime, offset in [(settings["dctime1"], 0), 
+                               (settings["dctime2"], settings["delay"])]:
+            zeros, ramp, dc = dcramplength(samplerate, 
+                                           float(settings["ramptime"]),
+                                           float(dctime), float(offset))
+            lengths.append(zeros+2*ramp+dc)
+        return max(lengths)
+    elif settings["output"] == "Finite":
+        pulse = len(np.arange(0, 1/float(settings["freq1"]), 
+                              1/int(settings["samplerate"])))
+        return pulse*int(settings["amount"]) + 1
+    return None
+
+
+def outputsamples(settings, waveformmatrix, index):
+    """
+    Return the samples of buildoutput at the given sample 
+    indices, without making the whole output. This is used
+    by the preview to only calculate what is visible.
+    """
+    index = np.asarray(index, dtype=np.int64)
+    samplerate = float(settings["samplerate"])
+    if isprofile(settings):
+        return profileoutput(settings).samples(index)
+    elif isdcramp(settings):
+        return np.vstack((dcrampsamples(index, samplerate, 
+                                        float(settings["ramptime"]),
+                                        float(settings["dctime1"]),
+                                        float(settings["offs1"]), 0),
+                          dcrampsamples(index, samplerate, 
+                                        float(settings["ramptime"]),
+                                        float(settings["dctime2"]),
+                                        float(settings["offs2"]),
+                                        float(settings["delay"]))))
+    elif settings["output"] == "Finite":
+        samplerate = int(settings["samplerate"])
+        rows = []
+        for channel in ("1", "2"):
+            freq = float(settings["freq"+channel])
+            pulse = len(np.arange(0, 1/freq, 1/samplerate))
+            length = pulse*int(settings["amount"])
+            shifted = index
+            if channel == "2":
+                # Channel 2 is rolled by the delay, like np.roll.
+                delay = int(float(samplerate)*float(settings["delay"]))
+                shifted = (index - delay) % length
+            if settings["waveform"+channel] == "Constant":
+                # Same as returnfinite, without the print.
+                y = np.zeros(len(index))
+            elif pulse <= len(index):
+                # Calculate one pulse and pick the samples from it.
+                y = returnfinite(np.arange(pulse)*(1/samplerate), 
+                                 settings["waveform"+channel], freq)
+                y = y[shifted % pulse]
+            else:
+                y = returnfinite((shifted % pulse)*(1/samplerate), 
+                                 settings["waveform"+channel], freq)
+            rows.append(np.where(index < length, y, 0.))
+        return np.vstack(rows)
+    else:
+        length = waveformmatrix.shape[1]
+        rows = []
+        for channel in ("1", "2"):
+            waveformvalue = WAVEFORMDICT[settings["waveform"+channel]]
+            skiprate = float(settings["freq"+channel])*length/samplerate
+            position = index % length
+            if channel == "2":
+                delay = int(samplerate*float(settings["delay"]))
+                position = (position - delay) % length
+            ind = ((position*skiprate) % length).astype(int)
+            rows.append(float(settings["amp"+channel])
+                        * waveformmatrix[waveformvalue,ind]
+                        + float(settings["offs"+channel]))
+        return np.vstack(rows)
@@ -0,0 +1,397 @@
+""" writerprocess.py
+This module runs the Writer in its own process, so the output of the
+DAQ does not have to share the GIL with matplotlib and tkinter. The
+Writerprocess class has the same methods as the Writer and sends them
+to the worker process over a command queue. Sample buffers are put in
+shared memory and only their names go over the queue. The replies and
+the done events of the task come back on a second queue.
+
+The worker keeps the output running when the window hangs, and when
+the window closes (or crashes) it turns the output off by itself.
+"""
+
+
+import itertools
+import multiprocessing
+import pickle
+import queue
+import threading
+from multiprocessing import shared_memory
+
+import numpy as np
+import nidaqmx
+
+from nidaqwriter import Writer, Simwriter
+
+
+__author__ = "Jaimy Plugge"
+
+
+# The attributes of the Writer that are set by the window before an
+# output is sent. They are sent along with every command.
+SYNCED = ["sample_rate", "rawoutput", "triggersource", "triggeredge",
+          "retriggerable"]
+
+# The commands that end a stream that is being written.
+STOPPING = ["pausefunc", "stopfunc", "changetask", "streamoutput",
+            "singleoutput", "outputcontinuously"]
+
+
+class Remoteoutput:
+    """
+    The worker side of a Sharedoutput (see parallelgen.py).
+    The window tells which chunks are ready, so the Writer can
+    stream them like in the window process.
+    """
+    def __init__(self, shmname, shape, dtype, chunksize):
+        self.shm = shared_memory.SharedMemory(name=shmname)
+        self.array = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf)
+        self.length = shape[1]
+        self.chunksize = chunksize
+        self.ready = queue.Queue()
+
+    def chunks(self):
+        while True:
+            chunk = self.ready.get()
+            if chunk is None:
+                return
+            start, stop = chunk
+            yield self.array[:,start:stop]
+
+    def close(self):
+        self.ready.put(None)
+        self.array = None
+        self.shm.close()
+
+
+def attachbuffer(name, shape, dtype):
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def packerror(error):
+    """
+    Make an exception that can be sent back to the window.
+    A DaqError can not be pickled, so it is sent as its message
+    and error code.
+    """
+    if isinstance(error, nidaqmx.DaqError):
+        return ("DaqError", str(error), error.error_code)
+    try:
+        pickle.loads(pickle.dumps(error))
+    except Exception:
+        return RuntimeError(repr(error))
+    return error
+
+
+def unpackerror(error):
+    if isinstance(error, tuple):
+        return nidaqmx.DaqError(error[1], error[2])
+    return error
+
+
+def workermain(commandqueue, returnqueue, chan_name1, chan_name2,
+               sample_rate, simulate):
+    """
+    Main function of the worker process. A thread receives the
+    commands, so the chunks of a stream still arrive while the
+    main thread is busy writing.
+    """
+    if simulate:
+        daqout = Simwriter(chan_name1, chan_name2, sample_rate)
+    else:
+        daqout = Writer(chan_name1, chan_name2, sample_rate)
+
+    def donecallback(task_handle, status, callback_data):
+        returnqueue.put(("done", status))
+        return 0
+
+    daqout.task.register_done_event(donecallback)
+    commands = queue.Queue()
+    # The streamed outputs by the name of their shared memory, so
+    # chunks that arrive early are not lost.
+    streams = {}
+    parent = multiprocessing.parent_process()
+
+    def receive():
+        while True:
+            try:
+                message = commandqueue.get(timeout=0.5)
+            except queue.Empty:
+                if parent is not None and not parent.is_alive():
+                    # The window is gone without closing the worker.
+                    commands.put(("exit", None, (), {}))
+                    return
+                continue
+            if message[0] == "chunk":
+                if message[1] in streams:
+                    streams[message[1]].ready.put(message[2])
+                continue
+            if message[0] == "streamoutput":
+                name, id, args, state = message
+                streams[args[0]] = Remoteoutput(*args)
+                message = (name, id, (streams[args[0]],), state)
+            commands.put(message)
+            if message[0] == "exit":
+                return
+
+    threading.Thread(target=receive, daemon=True).start()
+
+    def closestreams(keep=None):
+        for shmname in list(streams):
+            if streams[shmname] is not keep:
+                streams.pop(shmname).close()
+
+    while True:
+        name, id, args, state = commands.get()
+        if name == "exit":
+            closestreams()
+            try:
+                daqout.stopfunc()
+            except Exception:
+                pass
+            returnqueue.put(("exited", None))
+            return
+        for attribute, value in state.items():
+            setattr(daqout, attribute, value)
+        try:
+            if name in STOPPING:
+                # Unblock the stream before the Writer joins it.
+                for output in list(streams.values()):
+                    if output not in args:
+                        output.ready.put(None)
+            if name == "taskstop":
+                result = daqout.task.stop()
+            elif name == "streamoutput":
+                daqout.pausefunc()
+                closestreams(keep=args[0])
+                result = daqout.streamoutput(args[0])
+            elif name in ("singleoutput", "outputcontinuously"):
+                shm, samples = attachbuffer(*args[0])
+                try:
+                    # The driver copies the samples into its own
+                    # buffer, so the shared memory can be closed.
+                    result = getattr(daqout, name)(samples, *args[1:])
+                finally:
+                    del samples
+                    shm.close()
+            else:
+                result = getattr(daqout, name)(*args)
+                if name in ("pausefunc", "stopfunc", "changetask"):
+                    closestreams()
+                if name == "changetask":
+                    daqout.task.register_done_event(donecallback)
+            if id is not None:
+                returnqueue.put(("reply", id, True, result))
+        except Exception as error:
+            if id is None:
+                print(f"Writer process: {error!r}")
+                continue
+            returnqueue.put(("reply", id, False, packerror(error)))
+
+
+class Proxytask:
+    """
+    The part of nidaqmx.Task that the window uses.
+    """
+    def __init__(self, writerprocess):
+        self.writerprocess = writerprocess
+        self.done_callbacks = []
+
+    def register_done_event(self, callback_method):
+        if callback_method is None:
+            self.done_callbacks = []
+        else:
+            self.done_callbacks.append(callback_method)
+
+    def stop(self):
+        # This is called from the done callback, so do not wait for
+        # a reply.
+        self.writerprocess.send("taskstop")
+
+
+class Writerprocess:
+    def __init__(self, chan_name1, chan_name2, sample_rate, rawoutput=False,
+                 simulate=False):
+        self.sample_rate = sample_rate
+        self.rawoutput = rawoutput
+        self.triggersource = ""
+        self.triggeredge = "Rising"
+        self.retriggerable = False
+        self.chan_name1 = chan_name1
+        self.chan_name2 = chan_name2
+        self.multichan = len(chan_name2) > 0
+        self.task = Proxytask(self)
+
+        self.ids = itertools.count()
+        self.replies = {}
+        self.replylock = threading.Condition()
+        self.streamthread = None
+        self.streamstop = threading.Event()
+
+        # Spawn, because forking a process with tkinter in it is
+        # not safe.
+        context = multiprocessing.get_context("spawn")
+        self.commandqueue = context.Queue()
+        self.returnqueue = context.Queue()
+        self.process = context.Process(target=workermain,
+                                       args=(self.commandqueue,
+                                             self.returnqueue, chan_name1,
+                                             chan_name2, sample_rate,
+                                             simulate),
+                                       daemon=True)
+        self.process.start()
+        # The done callbacks get their own thread, so a callback that
+        # waits for the window never holds up the replies the window
+        # is waiting for.
+        self.donequeue = queue.Queue()
+        self.listener = threading.Thread(target=self.listen, daemon=True)
+        self.listener.start()
+        self.dispatcher = threading.Thread(target=self.dispatchdone, 
+                                           daemon=True)
+        self.dispatcher.start()
+
+    def listen(self):
+        """
+        Handle the messages of the worker: replies to calls and
+        done events, which go to the dispatcher thread.
+        """
+        while True:
+            message = self.returnqueue.get()
+            if message[0] == "done":
+                self.donequeue.put(message[1])
+            elif message[0] == "reply":
+                with self.replylock:
+                    self.replies[message[1]] = message[2:]
+                    self.replylock.notify_all()
+            elif message[0] == "exited":
+                self.donequeue.put(None)
+                return
+
+    def dispatchdone(self):
+        while True:
+            status = self.donequeue.get()
+            if status is None:
+                return
+            for callback_method in self.task.done_callbacks:
+                callback_method(0, status, None)
+
+    def call(self, name, *args):
+        """
+        Call a method of the Writer in the worker and wait for
+        the result.
+        """
+        if not self.process.is_alive():
+            raise RuntimeError("The writer process is not running")
+        id = next(self.ids)
+        state = {attribute: getattr(self, attribute) for attribute in SYNCED}
+        self.commandqueue.put((name, id, args, state))
+        with self.replylock:
+            while id not in self.replies:
+                if not self.replylock.wait(timeout=1):
+                    if not self.process.is_alive():
+                        raise RuntimeError("The writer process stopped")
+            ok, result = self.replies.pop(id)
+        if not ok:
+            raise unpackerror(result)
+        return result
+
+    def send(self, name, *args):
+        """
+        Call a method of the Writer in the worker without waiting.
+        """
+        state = {attribute: getattr(self, attribute) for attribute in SYNCED}
+        self.commandqueue.put((name, None, args, state))
+
+    def callwithbuffer(self, name, samples, *args):
+        samples = np.ascontiguousarray(samples)
+        shm = shared_memory.SharedMemory(create=True,
+                                         size=max(1, samples.nbytes))
+        try:
+            shared = np.ndarray(samples.shape, dtype=samples.dtype,
+                                buffer=shm.buf)
+            shared[:] = samples
+            del shared
+            return self.call(name, (shm.name, samples.shape,
+                                    samples.dtype.str), *args)
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def outputcontinuously(self, waveform, trigger=True):
+        return self.callwithbuffer("outputcontinuously", waveform, trigger)
+
+    def singleoutput(self, samples):
+        return self.callwithbuffer("singleoutput", samples)
+
+    def streamoutput(self, output, prefill=2):
+        self.stopstream()
+        # The worker waits for the first chunks before it replies,
+        # so start sending them first.
+        self.streamthread = threading.Thread(target=self.sendchunks,
+                                             args=(output,), daemon=True)
+        self.streamthread.start()
+        try:
+            self.call("streamoutput", output.shm.name, output.array.shape,
+                      output.array.dtype.str, output.chunksize)
+        except Exception:
+            self.stopstream()
+            raise
+
+    def sendchunks(self, output):
+        # Tell the worker about every chunk as soon as it is done.
+        for future in output.futures:
+            if self.streamstop.is_set():
+                return
+            try:
+                start, stop = future.result()
+            except Exception:
+                return
+            self.commandqueue.put(("chunk", output.shm.name, (start, stop)))
+
+    def stopstream(self):
+        if self.streamthread is not None:
+            self.streamstop.set()
+            self.streamthread.join()
+            self.streamthread = None
+            self.streamstop.clear()
+
+    def pausefunc(self):
+        self.stopstream()
+        return self.call("pausefunc")
+
+    def stopfunc(self):
+        """
+        Turn the output off and stop the worker process.
+        """
+        self.stopstream()
+        if not self.process.is_alive():
+            return
+        try:
+            self.call("stopfunc")
+        finally:
+            self.commandqueue.put(("exit", None, (), {}))
+            self.process.join(timeout=5)
+            if self.process.is_alive():
+                self.process.terminate()
+
+    def changetask(self, new_chan_name1, new_chan_name2):
+        self.stopstream()
+        self.chan_name1 = new_chan_name1
+        self.chan_name2 = new_chan_name2
+        self.multichan = len(new_chan_name2) > 0
+        return self.call("changetask", new_chan_name1, new_chan_name2)
+
+    def capabilities(self):
+        return self.call("capabilities")
+
+    def scalingcoefficients(self):
+        return self.call("scalingcoefficients")
+
+    def planoutput(self, sample_rate, samples, outputmode, 
+                   retriggerable=False, rawoutput=None):
+        return self.call("planoutput", sample_rate, samples, outputmode, 
+                         retriggerable, rawoutput)
+
+    def burstsfired(self):
+        return self.call("burstsfired")